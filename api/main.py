@@ -1,51 +1,1300 @@
-from fastapi import FastAPI, HTTPException, Request, Depends, Query, UploadFile, File
-from fastapi.responses import RedirectResponse
+from fastapi import FastAPI, HTTPException, Request, Depends, Query, UploadFile, BackgroundTasks
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-
-from firebase_admin import credentials, db, auth
-import firebase_admin
-
-import phonenumbers
-from phonenumbers import PhoneNumberFormat
+from starlette.datastructures import Headers, MutableHeaders
 
 from pydantic import BaseModel
-from typing import Optional
-
-from datetime import datetime
+from typing import Literal, Optional
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote
+import asyncio
+import contextvars
+import copy
+import functools
+import json
+import logging
 import os
+import threading
+import time
 import random
 import string
 import uuid
 import hashlib
 import base64
+import io
+import mimetypes
+import zlib
 
-import vercel_blob
+import orjson
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
-cred_info = {
-    "type": os.getenv("TYPE"),
-    "project_id": os.getenv("PROJECT_ID"),
-    "private_key_id": os.getenv("PRIVATE_KEY_ID"),
-    "private_key": os.getenv("PRIVATE_KEY").replace("\\n", "\n"),
-    "client_email": os.getenv("CLIENT_EMAIL"),
-    "client_id": os.getenv("CLIENT_ID"),
-    "auth_uri": os.getenv("AUTH_URI"),
-    "token_uri": os.getenv("TOKEN_URI"),
-    "auth_provider_x509_cert_url": os.getenv("AUTH_PROVIDER_CERT_URL"),
-    "client_x509_cert_url": os.getenv("CLIENT_CERT_URL")
-}
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+
+class TTLCache:
+    """Cache LRU em memória com expiração (TTL) e limite de entradas e de bytes.
+
+    None é um valor válido (serve para cache negativo); a ausência de entrada
+    é sinalizada por MISSING. O tamanho de cada valor é estimado pelo JSON
+    serializado (orjson). Os valores devolvidos são compartilhados entre
+    requisições e não devem ser alterados por quem os lê.
+
+    Quem vai buscar um valor para guardar pega antes generation_for(key) e
+    passa o número para set; se a chave foi invalidada no meio, a escrita é
+    descartada. As gerações são por chave (só das que estão sendo buscadas,
+    até max_entries delas), para que uma invalidação não descarte as buscas
+    em andamento de chaves que ela não afeta.
+    """
+
+    def __init__(self, ttl: float | None, max_entries: int, max_bytes: int | None = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._generations = OrderedDict()
+
+    def get(self, key, default=MISSING):
+        entry = self._entries.get(key)
+        if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        if entry is not None:
+            self._remove(key)
+        self.misses += 1
+        return default
+
+    def peek(self, key, default=MISSING):
+        entry = self._entries.get(key)
+        if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+            return entry[0]
+        return default
+
+    def generation_for(self, key) -> int:
+        generation = self._generations.setdefault(key, 0)
+        self._generations.move_to_end(key)
+        while len(self._generations) > self.max_entries:
+            self._generations.popitem(last=False)
+        return generation
+
+    def set(self, key, value, generation: int | None = None):
+        # Com generation, a escrita é descartada se houve invalidação desde
+        # que a leitura começou, para não guardar um valor já obsoleto. Uma
+        # chave que saiu de _generations conta como invalidada.
+        if generation is not None and self._generations.get(key) != generation:
+            return
+        size = len(orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS)) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self._entries[key] = (value, expires, size)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or (self.max_bytes and self._bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def touch(self, key):
+        # Renova a recência e o TTL sem serializar o valor de novo.
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self._entries[key] = (entry[0], expires, entry[2])
+        self._entries.move_to_end(key)
+
+    def invalidate(self, key):
+        if key in self._generations:
+            self._generations[key] += 1
+        if key in self._entries:
+            self._remove(key)
+
+    def invalidate_where(self, predicate):
+        for key in self._generations:
+            if predicate(key):
+                self._generations[key] += 1
+        for key in [key for key in self._entries if predicate(key)]:
+            self._remove(key)
+
+    def clear(self):
+        for key in self._generations:
+            self._generations[key] += 1
+        self._entries.clear()
+        self._bytes = 0
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+def caminhos_relacionados(a: str, b: str) -> bool:
+    # Dois caminhos se afetam quando são iguais ou um está dentro do outro.
+    return not a or not b or a == b or a.startswith(b + "/") or b.startswith(a + "/")
+
+class BackendError(Exception):
+    """Erro de uma operação no backend que não é "não encontrado"."""
+
+class _TransacaoAbortada(Exception):
+    """Levantada pela função de uma transação para desistir sem gravar nada."""
+
+class Backend(ABC):
+    """Interface dos dados usada pelo DataAccess.
+
+    Os métodos são síncronos (o DataAccess os roda nas suas threads) e os
+    caminhos do banco são strings relativas à raiz, com "" sendo a própria
+    raiz. get_user devolve None quando o UID não existe. Todos os métodos são
+    abstratos: um backend incompleto falha já na construção.
+    """
+
+    # Realtime Database
 
-cred = credentials.Certificate(cred_info)
-firebase_admin.initialize_app(cred, {"databaseURL": os.getenv("DATABASE_URL")})
+    @abstractmethod
+    def get(self, path: str, shallow: bool = False):
+        raise NotImplementedError
 
-ref = db.reference("/")
-agenda_ref = ref.child('agendas')
-agenda_membros_ref = ref.child('agenda_membros')
+    @abstractmethod
+    def get_with_etag(self, path: str):
+        # (valor, etag)
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_if_changed(self, path: str, etag: str):
+        # (mudou, valor, etag); se não mudou, o valor não é baixado.
+        raise NotImplementedError
+
+    @abstractmethod
+    def query(self, path: str, order_by: str, start_at=None, end_at=None, equal_to=None, limit_to_first=None, limit_to_last=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def update(self, path: str, value: dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, path: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def transaction(self, path: str, funcao):
+        # Aplica funcao(valor_atual) -> novo_valor atomicamente (o RTDB
+        # repete a função se o nó mudar no meio) e devolve o valor gravado.
+        # Como no firebase_admin, a função não pode devolver None (ValueError):
+        # para desistir, ela levanta uma exceção, que chega a quem chamou
+        # sem nada ser gravado.
+        raise NotImplementedError
+
+    @abstractmethod
+    def listen(self, path: str, callback):
+        # Chama callback(evento) a cada mudança abaixo de path, numa thread do
+        # backend; evento tem event_type ("put" ou "patch"), path (relativo a
+        # path, começando com "/") e data. O primeiro evento é um "put" em "/"
+        # com o nó inteiro. Devolve um objeto com close().
+        raise NotImplementedError
+
+    # Auth
+
+    @abstractmethod
+    def get_user(self, uid: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_users(self, uids):
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_users(self, page_token: str | None = None, max_results: int = 1000):
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_user(self, **kwargs):
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_user(self, uid: str, **kwargs):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_user(self, uid: str):
+        raise NotImplementedError
+
+    # Blob
+
+    @abstractmethod
+    def blob_list(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def blob_put(self, path: str, data: bytes, **kwargs) -> dict:
+        raise NotImplementedError
+
+    @abstractmethod
+    def blob_delete(self, url: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def blob_create_multipart(self, path: str) -> dict:
+        raise NotImplementedError
+
+    @abstractmethod
+    def blob_upload_part(self, upload: dict, part_number: int, data: bytes) -> dict:
+        raise NotImplementedError
+
+    @abstractmethod
+    def blob_complete_multipart(self, upload: dict, parts: list) -> dict:
+        raise NotImplementedError
+
+class FirebaseBackend(Backend):
+    """Backend de produção: firebase_admin (RTDB e Auth) e vercel_blob.
+
+    Nada é importado nem inicializado até o primeiro uso, para que o import
+    do main.py (que todo cold start paga) continue leve. A inicialização
+    acontece nas threads do DataAccess, fora do event loop, e o lock garante
+    que ela rode uma vez só.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ref = None
+        self._auth = None
+        self._exceptions = None
+        self._blob = None
+        self._http = None
+
+    def _init_firebase(self):
+        with self._lock:
+            if self._ref is not None:
+                return
+            import firebase_admin
+            from firebase_admin import auth, credentials, db, exceptions
+
+            cred_info = {
+                "type": os.getenv("TYPE"),
+                "project_id": os.getenv("PROJECT_ID"),
+                "private_key_id": os.getenv("PRIVATE_KEY_ID"),
+                "private_key": os.getenv("PRIVATE_KEY").replace("\\n", "\n"),
+                "client_email": os.getenv("CLIENT_EMAIL"),
+                "client_id": os.getenv("CLIENT_ID"),
+                "auth_uri": os.getenv("AUTH_URI"),
+                "token_uri": os.getenv("TOKEN_URI"),
+                "auth_provider_x509_cert_url": os.getenv("AUTH_PROVIDER_CERT_URL"),
+                "client_x509_cert_url": os.getenv("CLIENT_CERT_URL")
+            }
+
+            cred = credentials.Certificate(cred_info)
+            firebase_admin.initialize_app(cred, {"databaseURL": os.getenv("DATABASE_URL")})
+
+            self._auth = auth
+            self._exceptions = exceptions
+            self._ref = db.reference("/")
+
+    @property
+    def ref(self):
+        if self._ref is None:
+            self._init_firebase()
+        return self._ref
+
+    @property
+    def auth(self):
+        if self._ref is None:
+            self._init_firebase()
+        return self._auth
+
+    @property
+    def blob(self):
+        if self._blob is None:
+            with self._lock:
+                if self._blob is None:
+                    import vercel_blob
+                    self._blob = vercel_blob
+        return self._blob
+
+    def _reference(self, path: str):
+        return self.ref.child(path) if path else self.ref
+
+    # Realtime Database
+
+    def get(self, path: str, shallow: bool = False):
+        return self._reference(path).get(shallow=shallow)
+
+    def get_with_etag(self, path: str):
+        return self._reference(path).get(etag=True)
+
+    def get_if_changed(self, path: str, etag: str):
+        return self._reference(path).get_if_changed(etag)
+
+    def query(self, path: str, order_by: str, start_at=None, end_at=None, equal_to=None, limit_to_first=None, limit_to_last=None):
+        # order_by segue a convenção da API REST: "$key", "$value" ou o nome de um filho.
+        node = self._reference(path)
+        if order_by == "$key":
+            query = node.order_by_key()
+        elif order_by == "$value":
+            query = node.order_by_value()
+        else:
+            query = node.order_by_child(order_by)
+        if start_at is not None:
+            query = query.start_at(start_at)
+        if end_at is not None:
+            query = query.end_at(end_at)
+        if equal_to is not None:
+            query = query.equal_to(equal_to)
+        if limit_to_first is not None:
+            query = query.limit_to_first(limit_to_first)
+        if limit_to_last is not None:
+            query = query.limit_to_last(limit_to_last)
+        return query.get()
+
+    def update(self, path: str, value: dict):
+        self._reference(path).update(value)
+
+    def delete(self, path: str):
+        self._reference(path).delete()
+
+    def transaction(self, path: str, funcao):
+        return self._reference(path).transaction(funcao)
+
+    def listen(self, path: str, callback):
+        return self._reference(path).listen(callback)
+
+    # Auth
+
+    def get_user(self, uid: str):
+        try:
+            return self.auth.get_user(uid)
+        except self.auth.UserNotFoundError:
+            return None
+
+    def get_users(self, uids):
+        return self.auth.get_users([self.auth.UidIdentifier(uid) for uid in uids])
+
+    def list_users(self, page_token: str | None = None, max_results: int = 1000):
+        return self.auth.list_users(page_token=page_token, max_results=max_results)
+
+    def create_user(self, **kwargs):
+        return self.auth.create_user(**kwargs)
+
+    def update_user(self, uid: str, **kwargs):
+        try:
+            return self.auth.update_user(uid, **kwargs)
+        except self._exceptions.FirebaseError as e:
+            raise BackendError(str(e)) from e
+
+    def delete_user(self, uid: str):
+        self.auth.delete_user(uid)
+
+    # Vercel Blob
+
+    def blob_list(self):
+        return self.blob.list()
+
+    def blob_put(self, path: str, data: bytes, **kwargs) -> dict:
+        return self.blob.put(path, data, **kwargs)
+
+    def blob_delete(self, url: str):
+        return self.blob.delete(url)
+
+    # Upload multipart do Vercel Blob, parte por parte, direto pela API REST
+    # /mpu documentada pela Vercel. O vercel_blob.put só aceita o arquivo
+    # inteiro em bytes e as funções de multipart dele são privadas.
+
+    BLOB_API_URL = "https://blob.vercel-storage.com"
+    BLOB_API_VERSION = "10"
+    BLOB_CACHE_MAX_AGE = "31536000"
+
+    @property
+    def http(self):
+        if self._http is None:
+            with self._lock:
+                if self._http is None:
+                    import httpx
+                    self._http = httpx.Client(
+                        base_url=self.BLOB_API_URL,
+                        timeout=httpx.Timeout(30, connect=10),
+                        transport=httpx.HTTPTransport(retries=3),
+                    )
+        return self._http
+
+    def _mpu(self, acao: str, path: str, headers: dict, **kwargs):
+        resposta = self.http.post("/mpu", params={"pathname": path}, headers={**headers, "x-mpu-action": acao}, **kwargs)
+        if resposta.status_code >= 400:
+            raise BackendError(f"Vercel Blob /mpu ({acao}) respondeu {resposta.status_code}: {resposta.text[:200]}")
+        return resposta.json()
+
+    def blob_create_multipart(self, path: str) -> dict:
+        token = os.getenv("BLOB_READ_WRITE_TOKEN")
+        if not token:
+            raise BackendError("BLOB_READ_WRITE_TOKEN não configurado")
+        headers = {
+            "authorization": f"Bearer {token}",
+            "x-api-version": self.BLOB_API_VERSION,
+            "access": "public",
+            "x-content-type": mimetypes.guess_type(path)[0] or "application/octet-stream",
+            "x-cache-control-max-age": self.BLOB_CACHE_MAX_AGE,
+        }
+        info = self._mpu("create", path, headers)
+        return {"path": path, "upload_id": info["uploadId"], "key": info["key"], "headers": headers}
+
+    def _headers_do_upload(self, upload: dict) -> dict:
+        return {**upload["headers"], "x-mpu-upload-id": upload["upload_id"], "x-mpu-key": quote(upload["key"], safe="")}
+
+    def blob_upload_part(self, upload: dict, part_number: int, data: bytes) -> dict:
+        headers = {**self._headers_do_upload(upload), "x-mpu-part-number": str(part_number), "content-type": "application/octet-stream"}
+        resposta = self._mpu("upload", upload["path"], headers, content=data)
+        return {"partNumber": part_number, "etag": resposta["etag"]}
+
+    def blob_complete_multipart(self, upload: dict, parts: list) -> dict:
+        headers = {**self._headers_do_upload(upload), "content-type": "application/json"}
+        return self._mpu("complete", upload["path"], headers, content=orjson.dumps(parts))
+
+@dataclass
+class EventoDoBanco:
+    event_type: str
+    path: str
+    data: object
+
+class MemoryListener:
+    def __init__(self, backend: "InMemoryBackend", partes: list, callback):
+        self.backend = backend
+        self.partes = partes
+        self.callback = callback
+
+    def close(self):
+        with self.backend._lock:
+            if self in self.backend._listeners:
+                self.backend._listeners.remove(self)
+
+@dataclass
+class MemoryUser:
+    uid: str
+    email: str | None = None
+    display_name: str | None = None
+    phone_number: str | None = None
+    photo_url: str | None = None
+    password_hash: str | None = None
+    password_salt: str | None = None
+    email_verified: bool = False
+    disabled: bool = False
+
+@dataclass
+class MemoryUsersResult:
+    users: list
+    not_found: list
+
+@dataclass
+class MemoryUsersPage:
+    backend: "InMemoryBackend"
+    users: list
+    next_page_token: str
+    max_results: int
+
+    def get_next_page(self):
+        if not self.next_page_token:
+            return None
+        return self.backend.list_users(page_token=self.next_page_token, max_results=self.max_results)
+
+def _ordem_rtdb(valor):
+    # Ordem do RTDB para orderByChild/orderByValue: null, false, true,
+    # números, strings e por último objetos.
+    if valor is None:
+        return (0, 0)
+    if isinstance(valor, bool):
+        return (1, valor)
+    if isinstance(valor, (int, float)):
+        return (2, valor)
+    if isinstance(valor, str):
+        return (3, valor)
+    return (4, 0)
+
+def _ordem_chave_rtdb(chave: str):
+    # Chaves que são inteiros vêm antes, em ordem numérica; depois as strings.
+    return (0, int(chave), "") if chave.lstrip("-").isdigit() else (1, 0, chave)
+
+class InMemoryBackend(Backend):
+    """Backend em memória para rodar a API sem Firebase nem Vercel.
+
+    Modela a árvore do RTDB (com leituras shallow, consultas ordenadas e
+    updates multi-path), o cadastro de usuários do Auth e o Blob. latency
+    injeta um atraso por chamada, em segundos, por categoria ("db", "auth",
+    "blob"), para simular os round trips de rede nos benchmarks.
+    """
+
+    def __init__(self, latency: dict | None = None):
+        self.latency = latency or {}
+        self._lock = threading.Lock()
+        self._tree = {}
+        self._users = {}
+        self._blobs = {}
+        self._uploads = {}
+        self._listeners = []
+
+    def _esperar(self, categoria: str):
+        atraso = self.latency.get(categoria, 0)
+        if atraso:
+            time.sleep(atraso)
+
+    @staticmethod
+    def _partes(path: str) -> list:
+        return [parte for parte in path.split("/") if parte]
+
+    def _node(self, partes):
+        node = self._tree
+        for parte in partes:
+            if not isinstance(node, dict) or parte not in node:
+                return None
+            node = node[parte]
+        return node
+
+    def _set(self, partes, valor):
+        if not partes:
+            self._tree = copy.deepcopy(valor) if isinstance(valor, dict) else {}
+            return
+        if valor is None or valor == {}:
+            # Remove o nó e os pais que ficarem vazios, como o RTDB faz.
+            caminho = [self._tree]
+            for parte in partes[:-1]:
+                proximo = caminho[-1].get(parte)
+                if not isinstance(proximo, dict):
+                    return
+                caminho.append(proximo)
+            caminho[-1].pop(partes[-1], None)
+            for nivel in range(len(partes) - 1, 0, -1):
+                if caminho[nivel]:
+                    break
+                caminho[nivel - 1].pop(partes[nivel - 1], None)
+            return
+        node = self._tree
+        for parte in partes[:-1]:
+            if not isinstance(node.get(parte), dict):
+                node[parte] = {}
+            node = node[parte]
+        node[partes[-1]] = copy.deepcopy(valor)
+
+    # Realtime Database
+
+    def get(self, path: str, shallow: bool = False):
+        self._esperar("db")
+        with self._lock:
+            node = self._node(self._partes(path))
+            if shallow and isinstance(node, dict):
+                return {chave: True if isinstance(valor, dict) else valor for chave, valor in node.items()}
+            return copy.deepcopy(node)
+
+    @staticmethod
+    def _etag(node) -> str:
+        conteudo = json.dumps(node, sort_keys=True, separators=(",", ":")).encode()
+        return base64.b64encode(hashlib.sha1(conteudo).digest()).decode()
+
+    def get_with_etag(self, path: str):
+        self._esperar("db")
+        with self._lock:
+            node = self._node(self._partes(path))
+            return copy.deepcopy(node), self._etag(node)
+
+    def get_if_changed(self, path: str, etag: str):
+        self._esperar("db")
+        with self._lock:
+            node = self._node(self._partes(path))
+            atual = self._etag(node)
+            if atual == etag:
+                return False, None, etag
+            return True, copy.deepcopy(node), atual
+
+    def query(self, path: str, order_by: str, start_at=None, end_at=None, equal_to=None, limit_to_first=None, limit_to_last=None):
+        self._esperar("db")
+        with self._lock:
+            node = self._node(self._partes(path))
+            itens = list(node.items()) if isinstance(node, dict) else []
+
+            if order_by == "$key":
+                def ordem(item):
+                    return _ordem_chave_rtdb(item[0])
+                def valor(item):
+                    return item[0]
+            else:
+                def valor(item):
+                    if order_by == "$value":
+                        return item[1]
+                    return item[1].get(order_by) if isinstance(item[1], dict) else None
+                def ordem(item):
+                    return (_ordem_rtdb(valor(item)), _ordem_chave_rtdb(item[0]))
+
+            itens.sort(key=ordem)
+            if equal_to is not None:
+                start_at = end_at = equal_to
+            if start_at is not None:
+                itens = [item for item in itens if _ordem_rtdb(valor(item)) >= _ordem_rtdb(start_at)]
+            if end_at is not None:
+                itens = [item for item in itens if _ordem_rtdb(valor(item)) <= _ordem_rtdb(end_at)]
+            if limit_to_first is not None:
+                itens = itens[:limit_to_first]
+            if limit_to_last is not None:
+                itens = itens[-limit_to_last:]
+            return OrderedDict((chave, copy.deepcopy(item)) for chave, item in itens)
+
+    def update(self, path: str, value: dict):
+        self._esperar("db")
+        base = self._partes(path)
+        caminhos = ["/".join(base + self._partes(chave)) for chave in value]
+        for i, a in enumerate(caminhos):
+            for b in caminhos[i + 1:]:
+                if caminhos_relacionados(a, b):
+                    raise ValueError(f"Caminhos sobrepostos no mesmo update: {a} e {b}")
+        escritas = [(self._partes(caminho), valor) for caminho, valor in zip(caminhos, value.values())]
+        with self._lock:
+            for partes, valor in escritas:
+                self._set(partes, valor)
+            eventos = self._eventos(escritas)
+        self._notificar(eventos)
+
+    def delete(self, path: str):
+        self._esperar("db")
+        escritas = [(self._partes(path), None)]
+        with self._lock:
+            self._set(escritas[0][0], None)
+            eventos = self._eventos(escritas)
+        self._notificar(eventos)
+
+    def transaction(self, path: str, funcao):
+        self._esperar("db")
+        partes = self._partes(path)
+        with self._lock:
+            novo = funcao(copy.deepcopy(self._node(partes)))
+            if novo is None:
+                raise ValueError("Value must not be none.")
+            self._set(partes, novo)
+            eventos = self._eventos([(partes, novo)])
+        self._notificar(eventos)
+        return copy.deepcopy(novo)
+
+    def _eventos(self, escritas) -> list:
+        # Um "put" por escrita que cai dentro do nó escutado; uma escrita num
+        # ancestral manda o nó escutado inteiro de novo.
+        eventos = []
+        for listener in self._listeners:
+            n = len(listener.partes)
+            for partes, valor in escritas:
+                if partes[:n] == listener.partes:
+                    eventos.append((listener, EventoDoBanco("put", "/" + "/".join(partes[n:]), copy.deepcopy(valor))))
+                elif listener.partes[:len(partes)] == partes:
+                    eventos.append((listener, EventoDoBanco("put", "/", copy.deepcopy(self._node(listener.partes)))))
+        return eventos
+
+    @staticmethod
+    def _notificar(eventos):
+        for listener, evento in eventos:
+            try:
+                listener.callback(evento)
+            except Exception:
+                logger.exception("Falha num listener do backend em memória")
+
+    def listen(self, path: str, callback):
+        listener = MemoryListener(self, self._partes(path), callback)
+        with self._lock:
+            self._listeners.append(listener)
+            atual = copy.deepcopy(self._node(listener.partes))
+        callback(EventoDoBanco("put", "/", atual))
+        return listener
+
+    # Auth
+
+    def get_user(self, uid: str):
+        self._esperar("auth")
+        with self._lock:
+            return copy.copy(self._users.get(uid))
+
+    def get_users(self, uids):
+        self._esperar("auth")
+        with self._lock:
+            users = [copy.copy(self._users[uid]) for uid in uids if uid in self._users]
+            not_found = [uid for uid in uids if uid not in self._users]
+        return MemoryUsersResult(users=users, not_found=not_found)
+
+    def list_users(self, page_token: str | None = None, max_results: int = 1000):
+        self._esperar("auth")
+        with self._lock:
+            uids = sorted(uid for uid in self._users if page_token is None or uid > page_token)
+            pagina = [copy.copy(self._users[uid]) for uid in uids[:max_results]]
+        next_page_token = pagina[-1].uid if len(uids) > max_results else ""
+        return MemoryUsersPage(self, pagina, next_page_token, max_results)
+
+    def create_user(self, **kwargs):
+        self._esperar("auth")
+        uid = kwargs.pop("uid", None) or uuid.uuid4().hex
+        campos = {campo: kwargs.get(campo) for campo in ("email", "display_name", "phone_number", "photo_url")}
+        with self._lock:
+            if uid in self._users:
+                raise BackendError(f"O UID {uid} já existe")
+            user = MemoryUser(
+                uid=uid,
+                email_verified=bool(kwargs.get("email_verified")),
+                disabled=bool(kwargs.get("disabled")),
+                **campos,
+            )
+            self._users[uid] = user
+            return copy.copy(user)
+
+    def update_user(self, uid: str, **kwargs):
+        self._esperar("auth")
+        with self._lock:
+            user = self._users.get(uid)
+            if user is None:
+                raise BackendError(f"Nenhum usuário com o UID {uid}")
+            for campo, valor in kwargs.items():
+                if hasattr(user, campo):
+                    setattr(user, campo, valor)
+            return copy.copy(user)
+
+    def delete_user(self, uid: str):
+        self._esperar("auth")
+        with self._lock:
+            if self._users.pop(uid, None) is None:
+                raise BackendError(f"Nenhum usuário com o UID {uid}")
+
+    # Blob
+
+    def blob_list(self):
+        self._esperar("blob")
+        with self._lock:
+            return {"blobs": [
+                {"url": url, "pathname": blob["pathname"], "size": len(blob["data"])}
+                for url, blob in self._blobs.items()
+            ]}
+
+    def blob_put(self, path: str, data: bytes, **kwargs) -> dict:
+        self._esperar("blob")
+        url = f"memory://blob/{uuid.uuid4().hex}/{path}"
+        with self._lock:
+            self._blobs[url] = {"pathname": path, "data": bytes(data)}
+        return {"url": url, "pathname": path}
+
+    def blob_delete(self, url: str):
+        self._esperar("blob")
+        with self._lock:
+            if self._blobs.pop(url, None) is None:
+                raise BackendError(f"Blob não encontrado: {url}")
+
+    def blob_create_multipart(self, path: str) -> dict:
+        self._esperar("blob")
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._uploads[upload_id] = {}
+        return {"path": path, "upload_id": upload_id, "key": upload_id}
+
+    def blob_upload_part(self, upload: dict, part_number: int, data: bytes) -> dict:
+        self._esperar("blob")
+        with self._lock:
+            self._uploads[upload["upload_id"]][part_number] = bytes(data)
+        return {"partNumber": part_number, "etag": f"part-{part_number}"}
+
+    def blob_complete_multipart(self, upload: dict, parts: list) -> dict:
+        with self._lock:
+            partes = self._uploads.pop(upload["upload_id"])
+        data = b"".join(partes[part["partNumber"]] for part in sorted(parts, key=lambda part: part["partNumber"]))
+        return self.blob_put(upload["path"], data)
+
+def criar_backend() -> Backend:
+    # COSMOS_BACKEND=memory roda a API inteira em memória (desenvolvimento
+    # local e benchmarks); MEMORY_BACKEND_LATENCY_MS simula a rede.
+    if os.getenv("COSMOS_BACKEND", "firebase") == "memory":
+        atraso = float(os.getenv("MEMORY_BACKEND_LATENCY_MS", "0")) / 1000
+        return InMemoryBackend(latency={"db": atraso, "auth": atraso, "blob": atraso})
+    return FirebaseBackend()
+
+class SingleFlight:
+    """Junta chamadas simultâneas com a mesma chave numa só.
+
+    Enquanto uma chamada está em andamento, quem pede a mesma chave recebe o
+    mesmo resultado (ou a mesma exceção) em vez de repetir o round trip. Os
+    valores são compartilhados e, como no TTLCache, não devem ser alterados.
+    forget_where descarta chamadas que uma escrita tornou obsoletas: quem
+    chegar depois dispara uma nova.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight = {}
+
+    async def do(self, key, factory):
+        task = self._in_flight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(factory())
+            self._in_flight[key] = task
+            task.add_done_callback(functools.partial(self._done, key))
+        else:
+            self.coalesced += 1
+        # shield: se uma das requisições for cancelada, a chamada continua
+        # para as outras.
+        return await asyncio.shield(task)
+
+    def _done(self, key, task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if not task.cancelled():
+            task.exception()
+
+    def forget_where(self, predicate):
+        for key in [key for key in self._in_flight if predicate(key)]:
+            del self._in_flight[key]
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._in_flight)}
+
+AGENDA_CACHE_TTL = float(os.getenv("AGENDA_CACHE_TTL", "30"))
+AGENDA_CACHE_MAX_ENTRIES = int(os.getenv("AGENDA_CACHE_MAX_ENTRIES", "1024"))
+AGENDA_CACHE_MAX_BYTES = int(os.getenv("AGENDA_CACHE_MAX_BYTES", str(32 * 1024**2)))
+
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "4096"))
+
+INVITE_CACHE_TTL = float(os.getenv("INVITE_CACHE_TTL", "300"))
+INVITE_CACHE_MAX_ENTRIES = int(os.getenv("INVITE_CACHE_MAX_ENTRIES", "4096"))
+# Só para bancos em que o /admin/backfill/convites ainda não rodou: chaves
+# fora do índice caem numa consulta em agendas/ sem índice.
+INVITE_SCAN_FALLBACK = os.getenv("INVITE_SCAN_FALLBACK", "0") == "1"
+
+ETAG_CACHE_MAX_ENTRIES = int(os.getenv("ETAG_CACHE_MAX_ENTRIES", "4096"))
+ETAG_CACHE_MAX_BYTES = int(os.getenv("ETAG_CACHE_MAX_BYTES", str(32 * 1024**2)))
+
+IO_MAX_WORKERS = int(os.getenv("IO_MAX_WORKERS", "16"))
+
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "1000"))
+
+# Chamadas ao backend feitas durante a requisição atual, por categoria:
+# {"db": [chamadas, segundos], ...}. O middleware medir_requisicao cria o
+# dict; as tarefas filhas (asyncio.gather) herdam o mesmo objeto.
+medicoes_da_requisicao: contextvars.ContextVar[dict | None] = contextvars.ContextVar("medicoes_da_requisicao", default=None)
+
+def registrar_chamada_ao_backend(categoria: str, duracao: float):
+    medicoes = medicoes_da_requisicao.get()
+    if medicoes is not None:
+        medicao = medicoes.setdefault(categoria, [0, 0.0])
+        medicao[0] += 1
+        medicao[1] += duracao
+
+class Histograma:
+    """Histograma cumulativo no formato do Prometheus, com uma série por rótulos."""
+
+    def __init__(self, nome: str, descricao: str, buckets: tuple):
+        self.nome = nome
+        self.descricao = descricao
+        self.buckets = buckets
+        self._series = {}
+
+    def observar(self, valor: float, **rotulos):
+        chave = tuple(sorted(rotulos.items()))
+        serie = self._series.get(chave)
+        if serie is None:
+            serie = self._series[chave] = {"buckets": [0] * len(self.buckets), "soma": 0.0, "contagem": 0}
+        for i, limite in enumerate(self.buckets):
+            if valor <= limite:
+                serie["buckets"][i] += 1
+        serie["soma"] += valor
+        serie["contagem"] += 1
+
+    def exportar(self) -> str:
+        def formatar(rotulos):
+            return ",".join(f'{nome}="{valor}"' for nome, valor in rotulos)
+
+        linhas = [f"# HELP {self.nome} {self.descricao}", f"# TYPE {self.nome} histogram"]
+        for chave, serie in sorted(self._series.items()):
+            for limite, quantidade in zip(self.buckets, serie["buckets"]):
+                linhas.append(f'{self.nome}_bucket{{{formatar(chave + (("le", f"{limite:g}"),))}}} {quantidade}')
+            linhas.append(f'{self.nome}_bucket{{{formatar(chave + (("le", "+Inf"),))}}} {serie["contagem"]}')
+            linhas.append(f"{self.nome}_sum{{{formatar(chave)}}} {serie['soma']:.6f}")
+            linhas.append(f"{self.nome}_count{{{formatar(chave)}}} {serie['contagem']}")
+        return "\n".join(linhas)
+
+BUCKETS_DE_TEMPO = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BUCKETS_DE_CHAMADAS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250, 500)
+
+duracao_das_requisicoes = Histograma("cosmos_request_duration_seconds", "Tempo total da requisição, por rota.", BUCKETS_DE_TEMPO)
+duracao_no_backend = Histograma("cosmos_backend_duration_seconds", "Tempo somado das chamadas ao backend em cada requisição, por rota e categoria.", BUCKETS_DE_TEMPO)
+chamadas_ao_backend = Histograma("cosmos_backend_calls", "Chamadas ao backend (round trips) em cada requisição, por rota e categoria.", BUCKETS_DE_CHAMADAS)
+
+class DataAccess:
+    """Camada de acesso ao Realtime Database, ao Auth e ao Vercel Blob.
+
+    As operações em si ficam no Backend (FirebaseBackend em produção,
+    InMemoryBackend em desenvolvimento e nos benchmarks), que é síncrono como
+    os SDKs do firebase_admin e do vercel_blob. Cada chamada roda
+    num pool de threads limitado (IO_MAX_WORKERS) e é exposta como corrotina,
+    para que um round trip lento não trave o event loop do worker inteiro.
+    Os caminhos do banco são strings relativas à raiz ("agendas/{uid}");
+    o caminho vazio é a própria raiz.
+
+    Leituras em agendas/ passam pelo agenda_cache; toda escrita feita por aqui
+    invalida as entradas do cache que ela pode ter alterado. O user_cache
+    guarda o UserRecord de cada UID consultado por find_user (ou None, se o
+    usuário não existe) e é invalidado pelas escritas no Auth.
+
+    O etag_cache guarda a última leitura completa (etag, valor) dos caminhos
+    em REVALIDATED_PREFIXES. Quando a leitura precisa ir ao banco, ela manda
+    o ETag guardado (get_if_changed) e o RTDB só devolve o nó se ele mudou;
+    por isso essas entradas não precisam de TTL nem de invalidação.
+    """
+
+    CACHED_PREFIX = "agendas/"
+    REVALIDATED_PREFIXES = ("agendas/", "agenda_membros/", "agenda_membros_por_agenda/")
+
+    def __init__(self, backend: Backend, max_workers: int, agenda_cache: TTLCache | None = None, user_cache: TTLCache | None = None, etag_cache: TTLCache | None = None, single_flight: SingleFlight | None = None):
+        self.backend = backend
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="cosmos-io")
+        self.agenda_cache = agenda_cache
+        self.user_cache = user_cache
+        self.etag_cache = etag_cache
+        self.single_flight = single_flight
+        self.nao_modificados = 0
+
+    async def _coalesce(self, key, factory):
+        if self.single_flight is None:
+            return await factory()
+        return await self.single_flight.do(key, factory)
+
+    async def _run(self, categoria: str, func, *args, **kwargs):
+        # categoria ("db", "auth" ou "blob") é o que aparece no Server-Timing
+        # e no /metrics.
+        loop = asyncio.get_running_loop()
+        inicio = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+        finally:
+            registrar_chamada_ao_backend(categoria, time.perf_counter() - inicio)
+
+    # Realtime Database
+
+    def _cacheable(self, path: str) -> bool:
+        return self.agenda_cache is not None and path.startswith(self.CACHED_PREFIX)
+
+    @staticmethod
+    def _afetado(key, path: str) -> bool:
+        cached_path, shallow = key
+        if not caminhos_relacionados(cached_path, path):
+            return False
+        # Uma leitura shallow só mostra os valores do primeiro nível; escritas
+        # mais fundas (ex.: uma tarefa nova) não mudam o que ela devolve.
+        return not shallow or not path.startswith(cached_path + "/") or "/" not in path[len(cached_path) + 1:]
+
+    def _invalidate(self, *paths: str):
+        if self.agenda_cache is not None:
+            self.agenda_cache.invalidate_where(lambda key: any(self._afetado(key, path) for path in paths))
+        if self.single_flight is not None:
+            # Leituras em andamento começaram antes da escrita; quem ler
+            # depois dela não pode pegar carona nelas.
+            self.single_flight.forget_where(
+                lambda key: key[0] in ("get", "query") and any(caminhos_relacionados(key[1], path) for path in paths)
+            )
+
+    async def _read(self, path: str, shallow: bool):
+        # Leitura que sempre vai ao banco, revalidando pelo ETag quando dá.
+        # get_if_changed não aceita shallow, então essas leituras vão direto.
+        if shallow or self.etag_cache is None or not path.startswith(self.REVALIDATED_PREFIXES):
+            return await self._run("db", self.backend.get, path, shallow=shallow)
+
+        anterior = self.etag_cache.get(path)
+        if anterior is MISSING:
+            value, etag = await self._run("db", self.backend.get_with_etag, path)
+        else:
+            changed, value, etag = await self._run("db", self.backend.get_if_changed, path, anterior[0])
+            if not changed:
+                self.nao_modificados += 1
+                self.etag_cache.touch(path)
+                return anterior[1]
+        self.etag_cache.set(path, (etag, value))
+        return value
+
+    async def get(self, path: str, shallow: bool = False, cache: bool = True):
+        # cache=False vai sempre ao banco, para quem não pode decidir com um
+        # valor que talvez esteja velho (o vacuum, por exemplo).
+        if not cache or not self._cacheable(path):
+            return await self._coalesce(("get", path, shallow), lambda: self._read(path, shallow))
+
+        key = (path, shallow)
+        value = self.agenda_cache.get(key)
+        if value is MISSING:
+            generation = self.agenda_cache.generation_for(key)
+            value = await self._coalesce(("get", path, shallow), lambda: self._read(path, shallow))
+            self.agenda_cache.set(key, value, generation=generation)
+        return value
+
+    async def exists(self, path: str) -> bool:
+        # Responde pelo nó completo se ele já estiver em cache; senão basta
+        # uma leitura shallow, que não baixa as subárvores.
+        if self._cacheable(path):
+            value = self.agenda_cache.peek((path, False))
+            if value is not MISSING:
+                return bool(value)
+        return bool(await self.get(path, shallow=True))
+
+    async def query(self, path: str, order_by: str, start_at=None, end_at=None, equal_to=None, limit_to_first: int | None = None, limit_to_last: int | None = None):
+        key = ("query", path, order_by, start_at, end_at, equal_to, limit_to_first, limit_to_last)
+        return await self._coalesce(key, lambda: self._run(
+            "db", self.backend.query, path, order_by,
+            start_at=start_at, end_at=end_at, equal_to=equal_to,
+            limit_to_first=limit_to_first, limit_to_last=limit_to_last,
+        ))
+
+    async def update(self, path: str, value: dict):
+        try:
+            await self._run("db", self.backend.update, path, value)
+        finally:
+            self._invalidate(*(f"{path}/{key}" if path else key for key in value))
+
+    async def delete(self, path: str):
+        try:
+            await self._run("db", self.backend.delete, path)
+        finally:
+            self._invalidate(path)
+
+    async def transaction(self, path: str, funcao):
+        # Devolve None se a função desistiu levantando _TransacaoAbortada.
+        try:
+            return await self._run("db", self.backend.transaction, path, funcao)
+        except _TransacaoAbortada:
+            return None
+        finally:
+            self._invalidate(path)
+
+    async def listen(self, path: str, callback):
+        return await self._run("db", self.backend.listen, path, callback)
+
+    async def close_listener(self, listener):
+        await self._run("db", listener.close)
+
+    # Auth
+
+    async def get_user(self, uid: str):
+        return await self._coalesce(("user", uid), lambda: self._run("auth", self.backend.get_user, uid))
+
+    async def find_user(self, uid: str):
+        # UserRecord do UID, ou None se ele não existe. Erros do backend
+        # também dão None, mas não entram no cache.
+        if self.user_cache is not None:
+            user = self.user_cache.get(uid)
+            if user is not MISSING:
+                return user
+            generation = self.user_cache.generation_for(uid)
+
+        try:
+            user = await self.get_user(uid)
+        except Exception:
+            logger.exception("Falha ao buscar o usuário com o UID %s", uid)
+            return None
+        if user is None:
+            logger.debug("Nenhum usuário com o UID %s", uid)
+
+        if self.user_cache is not None:
+            self.user_cache.set(uid, user, generation=generation)
+        return user
+
+    async def get_users(self, uids):
+        uids = list(uids)
+        return await self._coalesce(("users", tuple(uids)), lambda: self._run("auth", self.backend.get_users, uids))
+
+    async def list_users(self, page_token: str | None = None, max_results: int = 1000):
+        return await self._run("auth", self.backend.list_users, page_token=page_token, max_results=max_results)
+
+    async def next_users_page(self, page):
+        return await self._run("auth", page.get_next_page)
+
+    def _invalidate_user(self, uid: str):
+        if self.user_cache is not None:
+            self.user_cache.invalidate(uid)
+        if self.single_flight is not None:
+            self.single_flight.forget_where(lambda key: key == ("user", uid) or (key[0] == "users" and uid in key[1]))
+
+    async def create_user(self, **kwargs):
+        user = await self._run("auth", self.backend.create_user, **kwargs)
+        self._invalidate_user(user.uid)
+        return user
+
+    async def update_user(self, uid: str, **kwargs):
+        try:
+            return await self._run("auth", self.backend.update_user, uid, **kwargs)
+        finally:
+            self._invalidate_user(uid)
+
+    async def delete_user(self, uid: str):
+        try:
+            await self._run("auth", self.backend.delete_user, uid)
+        finally:
+            self._invalidate_user(uid)
+
+    # Vercel Blob
+
+    async def blob_list(self):
+        return await self._run("blob", self.backend.blob_list)
+
+    async def blob_put(self, path: str, data: bytes, **kwargs):
+        return await self._run("blob", self.backend.blob_put, path, data, **kwargs)
+
+    async def blob_delete(self, url: str):
+        return await self._run("blob", self.backend.blob_delete, url)
+
+    async def blob_create_multipart(self, path: str) -> dict:
+        return await self._run("blob", self.backend.blob_create_multipart, path)
+
+    async def blob_upload_part(self, upload: dict, part_number: int, data: bytes) -> dict:
+        return await self._run("blob", self.backend.blob_upload_part, upload, part_number, data)
+
+    async def blob_complete_multipart(self, upload: dict, parts: list) -> dict:
+        return await self._run("blob", self.backend.blob_complete_multipart, upload, parts)
+
+agenda_cache = TTLCache(AGENDA_CACHE_TTL, AGENDA_CACHE_MAX_ENTRIES, AGENDA_CACHE_MAX_BYTES)
+user_cache = TTLCache(USER_CACHE_TTL, USER_CACHE_MAX_ENTRIES)
+etag_cache = TTLCache(None, ETAG_CACHE_MAX_ENTRIES, ETAG_CACHE_MAX_BYTES)
+single_flight = SingleFlight()
+data_access = DataAccess(criar_backend(), IO_MAX_WORKERS, agenda_cache, user_cache, etag_cache, single_flight)
+convite_cache = TTLCache(INVITE_CACHE_TTL, INVITE_CACHE_MAX_ENTRIES)
+
+SSE_MAX_SUBSCRIBERS = int(os.getenv("SSE_MAX_SUBSCRIBERS", "1000"))
+SSE_QUEUE_SIZE = int(os.getenv("SSE_QUEUE_SIZE", "100"))
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+
+class CanalLotado(Exception):
+    pass
+
+class CanalDeAgendas:
+    """Notificações de mudanças nas agendas para os assinantes do /stream/agenda.
+
+    Cada agenda com pelo menos um assinante tem um único listener no banco
+    (DataAccess.listen em agendas/{uid}), e cada evento dele é repassado para
+    a fila de todos os assinantes dessa agenda. As filas têm tamanho fixo: um
+    assinante que não acompanha perde os eventos pendentes e recebe um único
+    "recarregar". O número de assinantes por processo é limitado por
+    max_assinantes. Um None na fila encerra o stream.
+    """
+
+    def __init__(self, max_assinantes: int, tamanho_da_fila: int):
+        self.max_assinantes = max_assinantes
+        self.tamanho_da_fila = tamanho_da_fila
+        self.total = 0
+        self._assinantes = {}
+        self._listeners = {}
+
+    async def assinar(self, uid_da_agenda: str) -> asyncio.Queue:
+        if self.total >= self.max_assinantes:
+            raise CanalLotado()
+        fila = asyncio.Queue(self.tamanho_da_fila)
+        self._assinantes.setdefault(uid_da_agenda, set()).add(fila)
+        self.total += 1
+        if uid_da_agenda not in self._listeners:
+            self._listeners[uid_da_agenda] = asyncio.ensure_future(self._escutar(uid_da_agenda))
+        return fila
+
+    async def cancelar(self, uid_da_agenda: str, fila: asyncio.Queue):
+        assinantes = self._assinantes.get(uid_da_agenda)
+        if assinantes is None or fila not in assinantes:
+            return
+        assinantes.discard(fila)
+        self.total -= 1
+        if assinantes:
+            return
+        del self._assinantes[uid_da_agenda]
+        tarefa = self._listeners.pop(uid_da_agenda, None)
+        if tarefa is None:
+            return
+        try:
+            listener = await tarefa
+        except Exception:
+            return
+        await data_access.close_listener(listener)
+
+    async def _escutar(self, uid_da_agenda: str):
+        loop = asyncio.get_running_loop()
+        primeiro = True
+
+        def callback(evento):
+            # Roda numa thread do backend. O primeiro evento é o nó inteiro,
+            # que o cliente já tem.
+            nonlocal primeiro
+            if primeiro:
+                primeiro = False
+                return
+            for notificacao in self._notificacoes(evento):
+                loop.call_soon_threadsafe(self._publicar, uid_da_agenda, notificacao)
+
+        try:
+            return await data_access.listen(f"agendas/{uid_da_agenda}", callback)
+        except Exception:
+            logger.exception("Falha ao escutar a agenda %s", uid_da_agenda)
+            self._listeners.pop(uid_da_agenda, None)
+            for fila in self._assinantes.get(uid_da_agenda, ()):
+                self._enfileirar(fila, None)
+            raise
+
+    @staticmethod
+    def _notificacoes(evento) -> list:
+        # Um "patch" é um update com vários filhos; vira um "put" por filho.
+        base = evento.path.rstrip("/")
+        if evento.event_type == "patch" and isinstance(evento.data, dict):
+            escritas = [(f"{base}/{chave}", valor) for chave, valor in evento.data.items()]
+        else:
+            escritas = [(evento.path, evento.data)]
+
+        colecoes = {spec["colecao"] for spec in ITENS_DA_AGENDA.values()}
+        notificacoes = []
+        for caminho, dados in escritas:
+            partes = [parte for parte in caminho.split("/") if parte]
+            if not partes:
+                notificacoes.append({"acao": "agenda_deletada"} if dados is None else {"acao": "recarregar"})
+            elif partes[0] not in colecoes:
+                notificacoes.append({"acao": "agenda_alterada", "campo": partes[0]})
+            elif len(partes) == 1:
+                notificacoes.append({"acao": "recarregar", "colecao": partes[0]})
+            elif len(partes) == 2 and dados is None:
+                notificacoes.append({"acao": "deletado", "colecao": partes[0], "uid": partes[1]})
+            else:
+                notificacao = {"acao": "alterado", "colecao": partes[0], "uid": partes[1]}
+                if len(partes) == 2:
+                    notificacao["dados"] = dados
+                notificacoes.append(notificacao)
+        return notificacoes
+
+    def _publicar(self, uid_da_agenda: str, notificacao: dict):
+        for fila in self._assinantes.get(uid_da_agenda, ()):
+            self._enfileirar(fila, notificacao)
+
+    @staticmethod
+    def _enfileirar(fila: asyncio.Queue, notificacao):
+        try:
+            fila.put_nowait(notificacao)
+        except asyncio.QueueFull:
+            while not fila.empty():
+                fila.get_nowait()
+            fila.put_nowait({"acao": "recarregar"} if notificacao is not None else None)
+
+    def stats(self) -> dict:
+        return {"assinantes": self.total, "agendas": len(self._assinantes), "max_assinantes": self.max_assinantes}
+
+canal_de_agendas = CanalDeAgendas(SSE_MAX_SUBSCRIBERS, SSE_QUEUE_SIZE)
 
 def to_e164_br(phone_number):
+    import phonenumbers
+    from phonenumbers import PhoneNumberFormat
+
     try:
         parsed = phonenumbers.parse(phone_number, "BR")
         if phonenumbers.is_valid_number(parsed):
@@ -56,22 +1305,312 @@ def to_e164_br(phone_number):
         return None
 
 def timestamp_formatado(dt: datetime) -> str:
+    # Sempre em UTC e com largura fixa ("2025-06-27T14:00:00Z"), para que a
+    # ordem das strings seja a ordem cronológica e o RTDB consiga filtrar
+    # por faixa com order_by_child("timestamp"). Datas sem fuso são tratadas
+    # como hora local do servidor.
+    try:
+        return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    except (ValueError, OverflowError):
+        raise HTTPException(status_code=400, detail="Formato de timestamp inválido. Use ISO 8601 (ex: '2025-06-27T14:00:00Z')")
+
+def limite_de_timestamp(valor: str, fim_do_dia: bool = False) -> str:
+    # Converte o "desde"/"ate" da API para o formato gravado. Uma data sem
+    # hora cobre o dia inteiro; sem fuso, vale UTC.
     try:
-        return dt.replace(microsecond=0).isoformat()
+        dt = datetime.fromisoformat(valor)
     except ValueError:
-        raise HTTPException(status_code=400, detail="Formato de timestamp inválido. Use ISO 8601 (ex: '2025-06-27T14:00:00')")
+        raise HTTPException(status_code=400, detail=f"Data inválida: '{valor}'. Use ISO 8601 (ex: '2025-06-27' ou '2025-06-27T14:00:00Z')")
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    if fim_do_dia and len(valor) == 10:
+        dt += timedelta(days=1, seconds=-1)
+    return timestamp_formatado(dt)
+
+def caminhos_de_membro(uid_da_agenda: str, uid_do_membro: str, valor: dict | None) -> dict:
+    # O vínculo existe nos dois sentidos: agenda_membros/{uid}/{agenda} e
+    # agenda_membros_por_agenda/{agenda}/{uid}. Escrever os dois caminhos no
+    # mesmo update multi-path mantém o índice reverso sempre consistente.
+    return {
+        f"agenda_membros/{uid_do_membro}/{uid_da_agenda}": valor,
+        f"agenda_membros_por_agenda/{uid_da_agenda}/{uid_do_membro}": valor,
+    }
+
+def caminhos_de_remocao(uid_da_agenda: str, tipo: str, uid: str, agora: str) -> dict:
+    # Remove o item e deixa uma lápide em agenda_tombstones/{agenda}/{uid},
+    # com o timestamp da remoção, para o /sync/agenda avisar os clientes.
+    return {
+        f"agendas/{uid_da_agenda}/{ITENS_DA_AGENDA[tipo]['colecao']}/{uid}": None,
+        f"agenda_tombstones/{uid_da_agenda}/{uid}": {"tipo": tipo, "timestamp": agora},
+    }
+
+AUTH_GET_USERS_LIMIT = 100
+
+def perfil_do_usuario(user) -> dict:
+    return {
+        "uid": user.uid,
+        "email": user.email,
+        "display_name": user.display_name,
+        "phone_number": user.phone_number or "",
+        "photo_url": user.photo_url or ""
+    }
 
-def check_uid_exists(uid: str):
+def dados_completos_do_usuario(user) -> dict:
+    return {
+        "uid": user.uid,
+        "email": user.email,
+        "passwordHash": user.password_hash,
+        "passwordSalt": user.password_salt,
+        "display_name": user.display_name,
+        "phone_number": user.phone_number or "",
+        "photo_url": user.photo_url or ""
+    }
+
+async def resolver_perfis_de_usuarios(uids) -> dict:
+    # Busca só os UIDs pedidos, em lotes de até 100 (limite do auth.get_users),
+    # com os lotes rodando em paralelo. UIDs que não existem no Auth ficam
+    # mapeados para None.
+    uids = list(dict.fromkeys(uids))
+    lotes = [uids[i:i + AUTH_GET_USERS_LIMIT] for i in range(0, len(uids), AUTH_GET_USERS_LIMIT)]
+
+    resultados = await asyncio.gather(*(data_access.get_users(lote) for lote in lotes))
+
+    perfis = dict.fromkeys(uids)
+    for resultado in resultados:
+        for user in resultado.users:
+            perfis[user.uid] = perfil_do_usuario(user)
+    return perfis
+
+async def resolver_convite(chave_de_convite: str) -> str | None:
+    # chave_de_convite -> uid_da_agenda, pelo índice agenda_por_convite e com
+    # cache em memória. Chaves desconhecidas também ficam em cache (como None)
+    # para que uma rajada num link inválido custe uma única consulta. As
+    # chaves são sempre alfanuméricas (generate_random_invite_key); qualquer
+    # outra coisa nem chega ao banco, que recusa ".$#[]/" num caminho.
+    if not (chave_de_convite.isascii() and chave_de_convite.isalnum()):
+        return None
+    uid_da_agenda = convite_cache.get(chave_de_convite)
+    if uid_da_agenda is not MISSING:
+        return uid_da_agenda
+
+    generation = convite_cache.generation_for(chave_de_convite)
+    uid_da_agenda = await data_access.get(f"agenda_por_convite/{chave_de_convite}")
+    if uid_da_agenda is None and INVITE_SCAN_FALLBACK:
+        # Agendas criadas antes do índice: cai na consulta por chave_de_convite
+        # e já grava o índice para as próximas vezes.
+        agenda_data = await data_access.query("agendas", "chave_de_convite", equal_to=chave_de_convite, limit_to_first=1)
+        if agenda_data:
+            uid_da_agenda = next(iter(agenda_data))
+            await data_access.update("agenda_por_convite", {chave_de_convite: uid_da_agenda})
+
+    convite_cache.set(chave_de_convite, uid_da_agenda, generation=generation)
+    return uid_da_agenda
+
+FAN_OUT_LIMIT = int(os.getenv("FAN_OUT_LIMIT", "8"))
+CAMPOS_RESUMO_AGENDA = ("nome_agenda", "chave_de_convite", "firstCreated")
+
+async def buscar_agendas(agenda_ids, campos=None) -> dict:
+    # Lê várias agendas em paralelo, com no máximo FAN_OUT_LIMIT leituras em
+    # andamento. Com campos, faz uma leitura shallow (que traz os valores
+    # folha e só marca as subárvores como True) e devolve apenas esses campos,
+    # sem baixar tarefas, eventos e matérias.
+    semaforo = asyncio.Semaphore(FAN_OUT_LIMIT)
+
+    async def buscar(agenda_id):
+        async with semaforo:
+            agenda_data = await data_access.get(f"agendas/{agenda_id}", shallow=bool(campos))
+        if agenda_data and campos:
+            agenda_data = {campo: agenda_data.get(campo) for campo in campos}
+        return agenda_id, agenda_data
+
+    resultados = await asyncio.gather(*(buscar(agenda_id) for agenda_id in agenda_ids))
+    return {agenda_id: agenda_data for agenda_id, agenda_data in resultados if agenda_data}
+
+# Tarefas, eventos e matérias: coleção dentro da agenda, parâmetro da API ->
+# campo gravado, campo obrigatório na criação e se o item leva timestamp.
+ITENS_DA_AGENDA = {
+    "tarefa": {
+        "colecao": "tarefas",
+        "campos": {"nome_da_tarefa": "nome_da_tarefa"},
+        "obrigatorio": "nome_da_tarefa",
+        "timestamp": True,
+    },
+    "evento": {
+        "colecao": "eventos",
+        "campos": {"nome_do_evento": "nome_do_evento"},
+        "obrigatorio": "nome_do_evento",
+        "timestamp": True,
+    },
+    "materia": {
+        "colecao": "matérias",
+        "campos": {
+            "nome_da_matéria": "nome_matéria",
+            "nome_do_professor": "professor",
+            "horario_de_inicio_da_materia": "horario_de_início",
+            "horario_de_fim_da_materia": "horário_de_fim",
+        },
+        "obrigatorio": "nome_da_matéria",
+        "timestamp": True,
+    },
+}
+
+def montar_item(tipo: str, dados: dict, agora: str, parcial: bool = False) -> dict:
+    # Converte os parâmetros da API nos campos gravados no banco. Com parcial
+    # (atualização) só entram os campos enviados.
+    spec = ITENS_DA_AGENDA[tipo]
+    item = {
+        campo: dados.get(parametro)
+        for parametro, campo in spec["campos"].items()
+        if not parcial or dados.get(parametro) is not None
+    }
+    if spec["timestamp"]:
+        item["timestamp"] = agora
+    return item
+
+class RespostaJSON(JSONResponse):
+    """JSONResponse serializada com orjson (resposta padrão do app).
+
+    As rotas que devolvem árvores grandes retornam RespostaJSON direto, o que
+    também pula o jsonable_encoder do FastAPI, que percorre o dict inteiro
+    antes de serializar.
+    """
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=str, option=orjson.OPT_NON_STR_KEYS)
+
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "4"))
+
+TIPOS_COMPRIMIVEIS = ("application/json", "application/x-ndjson", "application/javascript", "text/")
+
+class CompressorBrotli:
+    def __init__(self, qualidade: int):
+        import brotli
+        self._compressor = brotli.Compressor(quality=qualidade)
+
+    def compress(self, dados: bytes) -> bytes:
+        return self._compressor.process(dados)
+
+    def flush(self) -> bytes:
+        return self._compressor.finish()
+
+def brotli_disponivel() -> bool:
     try:
-        user = auth.get_user(uid)
-        print(f"✅ User exists: {user.uid}, email: {user.email}")
-        return True
-    except auth.UserNotFoundError:
-        print("❌ No user found with that UID.")
-        return False
-    except Exception as e:
-        print(f"⚠️ Error: {e}")
+        import brotli  # noqa: F401
+    except ImportError:
         return False
+    return True
+
+def escolher_codificacao(accept_encoding: str) -> str | None:
+    # "br" se o cliente aceita e o pacote brotli está instalado, senão "gzip".
+    aceitas = {}
+    for item in accept_encoding.lower().split(","):
+        nome, _, parametros = item.strip().partition(";")
+        qualidade = 1.0
+        if parametros.strip().startswith("q="):
+            try:
+                qualidade = float(parametros.strip()[2:])
+            except ValueError:
+                qualidade = 0.0
+        aceitas[nome.strip()] = qualidade
+    if aceitas.get("br", 0) > 0 and brotli_disponivel():
+        return "br"
+    if aceitas.get("gzip", aceitas.get("*", 0)) > 0:
+        return "gzip"
+    return None
+
+def novo_compressor(codificacao: str):
+    if codificacao == "br":
+        return CompressorBrotli(BROTLI_QUALITY)
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+class CompressaoMiddleware:
+    """Comprime as respostas com brotli ou gzip, conforme o Accept-Encoding.
+
+    Respostas de corpo único só são comprimidas a partir de minimo bytes;
+    respostas em streaming (como o /getAllUsers) são comprimidas pedaço a
+    pedaço. Ficam de fora o SSE (text/event-stream, que precisa chegar evento
+    por evento), tipos que já vêm comprimidos e respostas que já têm
+    Content-Encoding.
+    """
+
+    def __init__(self, app, minimo: int = 1024):
+        self.app = app
+        self.minimo = minimo
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        codificacao = escolher_codificacao(Headers(scope=scope).get("accept-encoding", ""))
+        if codificacao is None:
+            await self.app(scope, receive, send)
+            return
+
+        inicio = None
+        compressor = None
+        repassar = False
+
+        async def enviar(message):
+            nonlocal inicio, compressor, repassar
+            if message["type"] == "http.response.start":
+                inicio = message
+                return
+            if message["type"] != "http.response.body" or repassar:
+                await send(message)
+                return
+
+            corpo = message.get("body", b"")
+            mais = message.get("more_body", False)
+            if compressor is None:
+                headers = MutableHeaders(raw=inicio["headers"])
+                tipo = headers.get("content-type", "")
+                if (
+                    "content-encoding" in headers
+                    or not tipo.startswith(TIPOS_COMPRIMIVEIS)
+                    or tipo.startswith("text/event-stream")
+                    or (not mais and len(corpo) < self.minimo)
+                ):
+                    repassar = True
+                    await send(inicio)
+                    await send(message)
+                    return
+
+                compressor = novo_compressor(codificacao)
+                headers["Content-Encoding"] = codificacao
+                headers.add_vary_header("Accept-Encoding")
+                if mais:
+                    del headers["Content-Length"]
+                else:
+                    corpo = compressor.compress(corpo) + compressor.flush()
+                    headers["Content-Length"] = str(len(corpo))
+                    await send(inicio)
+                    await send({"type": "http.response.body", "body": corpo})
+                    return
+                await send(inicio)
+
+            dados = compressor.compress(corpo)
+            if not mais:
+                dados += compressor.flush()
+            if dados or not mais:
+                await send({"type": "http.response.body", "body": dados, "more_body": mais})
+
+        await self.app(scope, receive, enviar)
+
+def resposta_com_etag(request: Request, conteudo) -> Response:
+    # ETag forte pelo hash do corpo. Se o cliente já tem essa versão
+    # (If-None-Match), responde 304 sem corpo.
+    corpo = orjson.dumps(conteudo, default=str, option=orjson.OPT_NON_STR_KEYS)
+    etag = '"' + hashlib.sha256(corpo).hexdigest()[:32] + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        etags_do_cliente = {valor.strip().removeprefix("W/") for valor in if_none_match.split(",")}
+        if etag in etags_do_cliente or "*" in etags_do_cliente:
+            return Response(status_code=304, headers=headers)
+    return Response(content=corpo, media_type="application/json", headers=headers)
 
 def generate_random_invite_key(length: int = 12) -> str:
     chars = string.ascii_letters + string.digits  # A-Z, a-z, 0-9
@@ -87,6 +1626,15 @@ def get_api_key(api_key: str = Query(default=None, alias=API_KEY_NAME)):
         return api_key
     raise HTTPException(status_code=403, detail="Chave API não autorizada")
 
+CRON_SECRET = os.getenv("CRON_SECRET")
+
+def autorizar_cron(request: Request, api_key: str = Query(default=None, alias=API_KEY_NAME)):
+    # O Vercel Cron não tem como mandar a api_key; ele manda o CRON_SECRET
+    # do projeto em Authorization: Bearer.
+    if CRON_SECRET and request.headers.get("authorization") == f"Bearer {CRON_SECRET}":
+        return None
+    get_api_key(api_key)
+
 # Size limits
 PHOTO_LIMIT = 5 * 1024**2
 VIDEO_LIMIT = 50 * 1024**2
@@ -111,6 +1659,607 @@ def get_file_category(content_type: str) -> str:
 def get_size_limit(category: str) -> int:
     return {"photo": PHOTO_LIMIT, "video": VIDEO_LIMIT, "document": DOCUMENT_LIMIT}.get(category, 0)
 
+# O upload é lido e enviado em partes deste tamanho (5 MB é o mínimo de uma
+# parte no multipart do Vercel Blob). O corpo multipart tem uma pequena folga
+# além do arquivo por causa dos cabeçalhos e delimitadores.
+UPLOAD_CHUNK_SIZE = 5 * 1024**2
+MULTIPART_OVERHEAD = 64 * 1024
+
+def arquivo_muito_grande(category: str, size_limit: int) -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=f"Arquivo do tipo {category.capitalize()} muito grande. Tamanho máximo: {size_limit // (1024**2)} MB"
+    )
+
+# Tamanho a partir do qual o arquivo recebido sai da memória para o disco.
+UPLOAD_SPOOL_SIZE = 1024**2
+
+async def receber_upload(request: Request) -> tuple[UploadFile, str, str, int]:
+    # Lê o corpo multipart direto do stream da requisição, em vez de deixar
+    # o Starlette receber tudo antes da rota. A categoria sai do Content-Type
+    # da parte "file" assim que os cabeçalhos dela chegam, e o upload é
+    # recusado no byte em que passa do limite da categoria. O SHA-256 é
+    # calculado no caminho. Devolve (arquivo, categoria, sha256, tamanho).
+    from tempfile import SpooledTemporaryFile
+    from python_multipart import MultipartParser
+    from python_multipart.multipart import parse_options_header
+
+    tipo, opcoes = parse_options_header(request.headers.get("content-type", ""))
+    if tipo != b"multipart/form-data" or b"boundary" not in opcoes:
+        raise HTTPException(status_code=400, detail="Envie o arquivo como multipart/form-data, no campo 'file'.")
+
+    eventos = []
+    parser = MultipartParser(opcoes[b"boundary"], {
+        "on_part_begin": lambda: eventos.append(("inicio", b"")),
+        "on_header_field": lambda dados, inicio, fim: eventos.append(("campo", dados[inicio:fim])),
+        "on_header_value": lambda dados, inicio, fim: eventos.append(("valor", dados[inicio:fim])),
+        "on_header_end": lambda: eventos.append(("fim_do_cabecalho", b"")),
+        "on_headers_finished": lambda: eventos.append(("cabecalhos", b"")),
+        "on_part_data": lambda dados, inicio, fim: eventos.append(("dados", dados[inicio:fim])),
+    })
+
+    arquivo = None
+    recebendo = False
+    category = size_limit = None
+    hasher = hashlib.sha256()
+    total = 0
+    campo = valor = b""
+    cabecalhos = []
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            for evento, dados in eventos:
+                if evento == "inicio":
+                    cabecalhos = []
+                    recebendo = False
+                elif evento == "campo":
+                    campo += dados
+                elif evento == "valor":
+                    valor += dados
+                elif evento == "fim_do_cabecalho":
+                    cabecalhos.append((campo.lower(), valor))
+                    campo = valor = b""
+                elif evento == "cabecalhos":
+                    headers = Headers(raw=cabecalhos)
+                    _, disposicao = parse_options_header(headers.get("content-disposition", ""))
+                    if disposicao.get(b"name") != b"file" or arquivo is not None:
+                        continue
+                    category = get_file_category(headers.get("content-type", ""))
+                    if category == "unknown":
+                        raise HTTPException(status_code=400, detail="Tipo de arquivo não suportado.")
+                    size_limit = get_size_limit(category)
+                    nome = disposicao.get(b"filename", b"").decode("utf-8", "replace")
+                    arquivo = UploadFile(SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE), filename=nome, headers=headers)
+                    recebendo = True
+                elif evento == "dados" and recebendo:
+                    total += len(dados)
+                    if total > size_limit:
+                        raise arquivo_muito_grande(category, size_limit)
+                    hasher.update(dados)
+                    await arquivo.write(dados)
+            eventos.clear()
+        parser.finalize()
+    except BaseException:
+        if arquivo is not None:
+            await arquivo.close()
+        raise
+
+    if arquivo is None:
+        raise HTTPException(status_code=400, detail="Nenhum arquivo enviado no campo 'file'.")
+    await arquivo.seek(0)
+    return arquivo, category, hasher.hexdigest(), total
+
+# Uploads deduplicados pelo conteúdo: blobs_por_hash/{sha256} guarda a URL
+# do objeto e quantas vezes ele foi enviado; blobs_por_url/{chave_do_blob(url)}
+# aponta de volta para o hash, para o delete achar a entrada. As variantes
+# das fotos ficam em blobs_variantes/{chave_do_blob(url)} -> hash do
+# original: elas pertencem ao original e só saem junto com ele.
+#
+# O RTDB não apaga um nó dentro de uma transação: o último delete deixa a
+# entrada como {"referencias": 0} e só então apaga o nó e os objetos. Uma
+# entrada assim conta como inexistente.
+
+def blob_ativo(entrada: dict | None) -> bool:
+    return bool(entrada) and entrada.get("referencias", 1) > 0
+
+def chave_do_blob(url: str) -> str:
+    # Chaves do RTDB não aceitam "/" nem ".", então a URL entra pelo hash.
+    return hashlib.sha256(url.encode()).hexdigest()
+
+async def reutilizar_blob(sha256: str) -> dict | None:
+    # Soma uma referência se o conteúdo já está no Blob; None se não está.
+    def incrementar(atual):
+        if not blob_ativo(atual):
+            raise _TransacaoAbortada
+        return {**atual, "referencias": atual.get("referencias", 0) + 1}
+
+    return await data_access.transaction(f"blobs_por_hash/{sha256}", incrementar)
+
+async def registrar_blob(sha256: str, url: str, pathname: str, tamanho: int) -> dict:
+    # Se outro upload do mesmo conteúdo registrou primeiro, fica valendo o
+    # dele e o objeto que acabou de ser enviado é apagado.
+    def registrar(atual):
+        if blob_ativo(atual):
+            return {**atual, "referencias": atual.get("referencias", 0) + 1}
+        return {"url": url, "pathname": pathname, "tamanho": tamanho, "referencias": 1}
+
+    entrada = await data_access.transaction(f"blobs_por_hash/{sha256}", registrar)
+    if entrada["url"] == url:
+        await data_access.update("", {f"blobs_por_url/{chave_do_blob(url)}": sha256})
+    else:
+        await data_access.blob_delete(url)
+    return entrada
+
+async def liberar_blob(url: str) -> int:
+    # Tira uma referência e só apaga o objeto quando era a última. Devolve
+    # quantas referências sobraram. URLs fora do índice (enviadas antes da
+    # deduplicação) são apagadas direto.
+    sha256, original = await asyncio.gather(
+        data_access.get(f"blobs_por_url/{chave_do_blob(url)}"),
+        data_access.get(f"blobs_variantes/{chave_do_blob(url)}"),
+    )
+    if original is not None:
+        raise HTTPException(status_code=400, detail="Esta URL é uma variante de outra imagem; ela é apagada junto com o original.")
+    if sha256 is None:
+        await data_access.blob_delete(url)
+        return 0
+
+    removida = None
+
+    def decrementar(atual):
+        nonlocal removida
+        removida = None
+        if not blob_ativo(atual):
+            raise _TransacaoAbortada
+        referencias = atual.get("referencias", 1) - 1
+        if referencias <= 0:
+            removida = atual
+            return {"referencias": 0}
+        return {**atual, "referencias": referencias}
+
+    restante = await data_access.transaction(f"blobs_por_hash/{sha256}", decrementar)
+    if restante is None:
+        # A entrada já foi apagada (ou está sendo, por outro delete); sobra
+        # só o objeto desta URL.
+        await data_access.update("", {f"blobs_por_url/{chave_do_blob(url)}": None})
+        await data_access.blob_delete(url)
+        return 0
+    if removida is not None:
+        variantes = list((removida.get("variantes") or {}).values())
+        await data_access.update("", {
+            f"blobs_por_hash/{sha256}": None,
+            f"blobs_por_url/{chave_do_blob(url)}": None,
+            **{f"blobs_variantes/{chave_do_blob(variante)}": None for variante in variantes},
+        })
+        await data_access.blob_delete(url)
+        for variante in variantes:
+            await data_access.blob_delete(variante)
+    return restante["referencias"]
+
+# Variantes das fotos: nome -> (maior lado em px, formato do Pillow,
+# extensão, qualidade). Ficam em blobs_por_hash/{sha256}/variantes, junto
+# do original, e são apagadas com ele.
+VARIANTES_DE_IMAGEM = {
+    "webp": (2048, "WEBP", "webp", 80),
+    "medium": (1024, "JPEG", "jpg", 82),
+    "thumb": (256, "JPEG", "jpg", 80),
+}
+IMAGE_VARIANTS_MODE = os.getenv("IMAGE_VARIANTS_MODE", "adiada")
+IMAGE_MAX_WORKERS = int(os.getenv("IMAGE_MAX_WORKERS", "2"))
+# Enquanto as variantes de um hash estão sendo geradas, ou logo depois de a
+# geração falhar, novos uploads do mesmo conteúdo não tentam de novo. Passado
+# esse tempo a marca vence (o processo pode ter morrido no meio, ou a falha
+# pode ter sido passageira).
+IMAGE_VARIANTS_LEASE_SECONDS = int(os.getenv("IMAGE_VARIANTS_LEASE_SECONDS", "600"))
+MARCAS_DE_VARIANTES = ("variantes_estado", "variantes_desde")
+
+def gerar_variantes_de_imagem(dados: bytes) -> dict:
+    # Roda no pool de imagens, fora do processo da API: recebe os bytes do
+    # original e devolve {nome: (bytes, extensão)}. Cada variante é reduzida
+    # a partir da anterior, da maior para a menor.
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(dados)) as original:
+        imagem = ImageOps.exif_transpose(original)
+        imagem = imagem.convert("RGBA" if imagem.mode in ("RGBA", "LA", "P") else "RGB")
+
+    variantes = {}
+    for nome, (lado, formato, extensao, qualidade) in sorted(VARIANTES_DE_IMAGEM.items(), key=lambda item: -item[1][0]):
+        imagem = imagem.copy()
+        imagem.thumbnail((lado, lado), Image.Resampling.LANCZOS)
+        saida = imagem
+        if formato == "JPEG" and imagem.mode == "RGBA":
+            saida = Image.new("RGB", imagem.size, (255, 255, 255))
+            saida.paste(imagem, mask=imagem.getchannel("A"))
+        buffer = io.BytesIO()
+        if formato == "JPEG":
+            saida.save(buffer, formato, quality=qualidade, optimize=True, progressive=True)
+        else:
+            saida.save(buffer, formato, quality=qualidade, method=4)
+        variantes[nome] = (buffer.getvalue(), extensao)
+    return variantes
+
+_pool_de_imagens = None
+
+def pool_de_imagens():
+    # Criado no primeiro uso, com no máximo IMAGE_MAX_WORKERS processos. Onde
+    # não há multiprocessing (alguns ambientes serverless não têm /dev/shm),
+    # cai para threads, já que o Pillow solta o GIL no trabalho pesado.
+    # Os processos não nascem de um fork deste: a essa altura ele já tem as
+    # threads do DataAccess e do Firebase, e um fork pode herdar um lock
+    # travado por uma delas. Com forkserver (ou spawn, onde não há) cada
+    # processo começa limpo e importa este módulo para achar a função.
+    global _pool_de_imagens
+    if _pool_de_imagens is None:
+        try:
+            import multiprocessing
+            metodo = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _pool_de_imagens = ProcessPoolExecutor(max_workers=IMAGE_MAX_WORKERS, mp_context=multiprocessing.get_context(metodo))
+        except (OSError, NotImplementedError, ImportError):
+            logger.warning("Sem suporte a processos; as variantes de imagem vão rodar em threads")
+            _pool_de_imagens = ThreadPoolExecutor(max_workers=IMAGE_MAX_WORKERS, thread_name_prefix="cosmos-imagens")
+    return _pool_de_imagens
+
+async def reservar_variantes(sha256: str) -> tuple[str, dict | None]:
+    # Marca a entrada como "gerando" se ninguém gerou nem está gerando as
+    # variantes dela. Devolve o estado encontrado ("reservado", "prontas",
+    # "gerando", "falhou" ou "sem_original") e a entrada.
+    agora = datetime.now()
+    vencido = timestamp_formatado(agora - timedelta(seconds=IMAGE_VARIANTS_LEASE_SECONDS))
+    estado, encontrada = None, None
+
+    def reservar(atual):
+        nonlocal estado, encontrada
+        estado, encontrada = "sem_original", atual
+        if not blob_ativo(atual):
+            raise _TransacaoAbortada
+        if atual.get("variantes"):
+            estado = "prontas"
+            raise _TransacaoAbortada
+        if atual.get("variantes_estado") and atual.get("variantes_desde", "") >= vencido:
+            estado = atual["variantes_estado"]
+            raise _TransacaoAbortada
+        estado = "reservado"
+        return {**atual, "variantes_estado": "gerando", "variantes_desde": timestamp_formatado(agora)}
+
+    entrada = await data_access.transaction(f"blobs_por_hash/{sha256}", reservar)
+    return estado, entrada if entrada is not None else encontrada
+
+async def marcar_variantes_com_falha(sha256: str):
+    def marcar(atual):
+        if not blob_ativo(atual) or atual.get("variantes"):
+            raise _TransacaoAbortada
+        return {**atual, "variantes_estado": "falhou", "variantes_desde": timestamp_formatado(datetime.now())}
+
+    await data_access.transaction(f"blobs_por_hash/{sha256}", marcar)
+
+async def criar_variantes(sha256: str, pathname: str, dados: bytes) -> dict:
+    # Gera as variantes, envia para o Blob e anexa as URLs à entrada do
+    # original; quem chama já reservou a geração com reservar_variantes.
+    # Falhas (imagem inválida, por exemplo) só vão para o log e para a marca
+    # "falhou" da entrada: o original já está salvo e a resposta fica sem
+    # variantes.
+    try:
+        loop = asyncio.get_running_loop()
+        geradas = await loop.run_in_executor(pool_de_imagens(), gerar_variantes_de_imagem, dados)
+
+        raiz = pathname.rsplit(".", 1)[0]
+        respostas = await asyncio.gather(*(
+            data_access.blob_put(f"{raiz}_{nome}.{extensao}", conteudo, verbose=False)
+            for nome, (conteudo, extensao) in geradas.items()
+        ))
+        urls = {nome: resp.get("url") for nome, resp in zip(geradas, respostas)}
+        anexadas = None
+
+        def anexar(atual):
+            nonlocal anexadas
+            anexadas = None
+            if not blob_ativo(atual):
+                raise _TransacaoAbortada
+            if atual.get("variantes"):
+                anexadas = atual["variantes"]
+                raise _TransacaoAbortada
+            limpa = {campo: valor for campo, valor in atual.items() if campo not in MARCAS_DE_VARIANTES}
+            return {**limpa, "variantes": urls}
+
+        if await data_access.transaction(f"blobs_por_hash/{sha256}", anexar) is None:
+            # O original foi apagado, ou outro upload anexou as variantes antes.
+            await asyncio.gather(*(data_access.blob_delete(url) for url in urls.values()))
+            return anexadas or {}
+        await data_access.update("", {f"blobs_variantes/{chave_do_blob(url)}": sha256 for url in urls.values()})
+        return urls
+    except Exception:
+        logger.exception("Falha ao gerar as variantes da imagem %s", sha256)
+        try:
+            await marcar_variantes_com_falha(sha256)
+        except Exception:
+            logger.exception("Falha ao marcar as variantes da imagem %s", sha256)
+        return {}
+
+JOBS_MAX_ATTEMPTS = int(os.getenv("JOBS_MAX_ATTEMPTS", "5"))
+JOBS_RETRY_BASE_SECONDS = float(os.getenv("JOBS_RETRY_BASE_SECONDS", "30"))
+JOBS_LEASE_SECONDS = int(os.getenv("JOBS_LEASE_SECONDS", "300"))
+JOBS_BATCH_SIZE = int(os.getenv("JOBS_BATCH_SIZE", "200"))
+JOBS_TIME_BUDGET_SECONDS = float(os.getenv("JOBS_TIME_BUDGET_SECONDS", "45"))
+
+class FilaDeJobs:
+    """Jobs de limpeza executados fora do caminho da resposta.
+
+    Cada job fica gravado em jobs/{id} (tipo, parâmetros, status, tentativas,
+    progresso e erro), e o /jobs/{id} mostra esse registro. Não existe worker
+    próprio do processo: na Vercel a instância pode ser congelada assim que a
+    resposta sai. Um job sempre roda dentro de uma requisição, com no máximo
+    orcamento segundos: primeiro nas BackgroundTasks da requisição que o
+    criou e, se não terminar ali, no /admin/jobs/processar, que o Vercel Cron
+    chama periodicamente.
+
+    Os executores são geradores assíncronos que recebem os parâmetros e o
+    progresso salvo e produzem o progresso novo a cada lote, que é gravado
+    no job. Um job interrompido pelo limite de tempo volta para "pendente" e
+    continua de onde parou na próxima execução. Uma falha conta uma
+    tentativa e adia a próxima com espera exponencial (proxima_tentativa);
+    depois de max_tentativas o job fica como "falhou". Um job "executando"
+    cujo registro não é atualizado há mais de lease_segundos é de uma
+    execução que morreu no meio e pode ser retomado.
+    """
+
+    def __init__(self, executores: dict, max_tentativas: int, espera_base: float, lease_segundos: int, orcamento: float):
+        self.executores = executores
+        self.max_tentativas = max_tentativas
+        self.espera_base = espera_base
+        self.lease_segundos = lease_segundos
+        self.orcamento = orcamento
+        self.concluidos = 0
+        self.falhas = 0
+
+    async def enfileirar(self, tipo: str, parametros: dict, background_tasks: BackgroundTasks | None = None) -> str:
+        id_do_job = str(uuid.uuid4())
+        agora = timestamp_formatado(datetime.now())
+        await data_access.update(f"jobs/{id_do_job}", {
+            "tipo": tipo,
+            "parametros": parametros,
+            "status": "pendente",
+            "tentativas": 0,
+            "criado": agora,
+            "atualizado": agora,
+            "proxima_tentativa": agora,
+        })
+        if background_tasks is not None:
+            background_tasks.add_task(self.executar, id_do_job)
+        return id_do_job
+
+    async def processar_pendentes(self) -> dict:
+        # Roda, em ordem de criação, os jobs que podem rodar agora, até
+        # acabar o orçamento de tempo desta requisição.
+        limite = time.monotonic() + self.orcamento
+        agora = timestamp_formatado(datetime.now())
+        vencido = timestamp_formatado(datetime.now() - timedelta(seconds=self.lease_segundos))
+        pendentes, executando = await asyncio.gather(
+            data_access.query("jobs", "status", equal_to="pendente"),
+            data_access.query("jobs", "status", equal_to="executando"),
+        )
+        prontos = [
+            (job.get("criado", ""), id_do_job)
+            for id_do_job, job in {**(pendentes or {}), **(executando or {})}.items()
+            if (job.get("status") == "pendente" and job.get("proxima_tentativa", "") <= agora)
+            or (job.get("status") == "executando" and job.get("atualizado", "") < vencido)
+        ]
+
+        resultado = {"executados": 0, "concluidos": 0, "restantes": 0}
+        for _, id_do_job in sorted(prontos):
+            if time.monotonic() >= limite:
+                resultado["restantes"] += 1
+                continue
+            status = await self.executar(id_do_job, limite)
+            if status is not None:
+                resultado["executados"] += 1
+                resultado["concluidos"] += status == "concluido"
+        return resultado
+
+    async def _reservar(self, id_do_job: str) -> dict | None:
+        # Passa o job para "executando" numa transação, para que duas
+        # requisições não peguem o mesmo job.
+        agora = timestamp_formatado(datetime.now())
+        vencido = timestamp_formatado(datetime.now() - timedelta(seconds=self.lease_segundos))
+        reservado = None
+
+        def reservar(atual):
+            nonlocal reservado
+            reservado = None
+            # Um job apagado depois da listagem, ou que outra execução já
+            # pegou, fica de fora sem nada ser gravado.
+            if not atual:
+                raise _TransacaoAbortada
+            status = atual.get("status")
+            livre = (status == "pendente" and atual.get("proxima_tentativa", "") <= agora) or (status == "executando" and atual.get("atualizado", "") < vencido)
+            if not livre:
+                raise _TransacaoAbortada
+            reservado = {**atual, "status": "executando", "atualizado": agora}
+            return reservado
+
+        await data_access.transaction(f"jobs/{id_do_job}", reservar)
+        return reservado
+
+    async def executar(self, id_do_job: str, limite: float | None = None) -> str | None:
+        # Roda um job até ele terminar, falhar ou passar do limite (um
+        # time.monotonic()). Devolve o status em que ele ficou, ou None se
+        # o job não estava livre para rodar.
+        limite = limite if limite is not None else time.monotonic() + self.orcamento
+        job = await self._reservar(id_do_job)
+        if job is None:
+            return None
+
+        lotes = self.executores[job["tipo"]](job.get("parametros") or {}, job.get("progresso") or {})
+        try:
+            async for progresso in lotes:
+                agora = timestamp_formatado(datetime.now())
+                if time.monotonic() < limite:
+                    await data_access.update(f"jobs/{id_do_job}", {"progresso": progresso, "atualizado": agora})
+                    continue
+                await data_access.update(f"jobs/{id_do_job}", {"progresso": progresso, "status": "pendente", "atualizado": agora, "proxima_tentativa": agora})
+                return "pendente"
+        except Exception as erro:
+            tentativas = job.get("tentativas", 0) + 1
+            logger.exception("Falha no job %s (%s), tentativa %d", id_do_job, job["tipo"], tentativas)
+            final = tentativas >= self.max_tentativas
+            agora = datetime.now()
+            await data_access.update(f"jobs/{id_do_job}", {
+                "status": "falhou" if final else "pendente",
+                "tentativas": tentativas,
+                "erro": f"{type(erro).__name__}: {erro}",
+                "atualizado": timestamp_formatado(agora),
+                "proxima_tentativa": timestamp_formatado(agora + timedelta(seconds=self.espera_base * 2 ** (tentativas - 1))),
+            })
+            if final:
+                self.falhas += 1
+            return "falhou" if final else "pendente"
+        finally:
+            await lotes.aclose()
+
+        await data_access.update(f"jobs/{id_do_job}", {"status": "concluido", "erro": None, "atualizado": timestamp_formatado(datetime.now())})
+        self.concluidos += 1
+        return "concluido"
+
+    def stats(self) -> dict:
+        return {"concluidos": self.concluidos, "falhas": self.falhas}
+
+async def remover_vinculos(pares) -> int:
+    # pares: (uid_da_agenda, uid_do_membro). Apaga os dois lados de cada
+    # vínculo em updates multi-path de até JOBS_BATCH_SIZE vínculos.
+    pares = list(pares)
+    for inicio in range(0, len(pares), JOBS_BATCH_SIZE):
+        caminhos = {}
+        for uid_da_agenda, uid_do_membro in pares[inicio:inicio + JOBS_BATCH_SIZE]:
+            caminhos.update(caminhos_de_membro(uid_da_agenda, uid_do_membro, None))
+        await data_access.update("", caminhos)
+    return len(pares)
+
+async def limpar_agenda(parametros: dict, progresso: dict):
+    # Depois de /delete/agenda: tira a agenda do agenda_membros de cada
+    # membro, lendo os membros pelo índice reverso um lote por vez.
+    uid_da_agenda = parametros["uid_da_agenda"]
+    removidos = progresso.get("vinculos_removidos", 0)
+    while True:
+        membros = await data_access.query(f"agenda_membros_por_agenda/{uid_da_agenda}", "$key", limit_to_first=JOBS_BATCH_SIZE)
+        if not membros:
+            return
+        removidos += await remover_vinculos((uid_da_agenda, uid_do_membro) for uid_do_membro in membros)
+        yield {"vinculos_removidos": removidos}
+
+async def limpar_usuario(parametros: dict, progresso: dict):
+    # Depois de /delete/user: tira o usuário de todas as agendas dele.
+    uid_do_usuario = parametros["uid_do_usuario"]
+    removidos = progresso.get("vinculos_removidos", 0)
+    while True:
+        agendas = await data_access.query(f"agenda_membros/{uid_do_usuario}", "$key", limit_to_first=JOBS_BATCH_SIZE)
+        if not agendas:
+            return
+        removidos += await remover_vinculos((uid_da_agenda, uid_do_usuario) for uid_da_agenda in agendas)
+        yield {"vinculos_removidos": removidos}
+
+async def agendas_existentes(agenda_ids) -> set:
+    # Como buscar_agendas, mas sem cache e só com os IDs que existem.
+    semaforo = asyncio.Semaphore(FAN_OUT_LIMIT)
+
+    async def existe(agenda_id):
+        async with semaforo:
+            return agenda_id, bool(await data_access.get(f"agendas/{agenda_id}", shallow=True, cache=False))
+
+    resultados = await asyncio.gather(*(existe(agenda_id) for agenda_id in agenda_ids))
+    return {agenda_id for agenda_id, existe in resultados if existe}
+
+async def vacuum(parametros: dict, progresso: dict):
+    # Percorre agenda_membros e depois agenda_membros_por_agenda, uma página
+    # de JOBS_BATCH_SIZE chaves por vez, e remove os vínculos cuja agenda ou
+    # cujo usuário não existe mais. O cursor da página fica no progresso.
+    fases = ("agenda_membros", "agenda_membros_por_agenda")
+    fase = progresso.get("fase", fases[0])
+    cursor = progresso.get("cursor")
+    verificados = progresso.get("verificados", 0)
+    removidos = progresso.get("removidos", 0)
+
+    for nome in fases[fases.index(fase):]:
+        while True:
+            # start_at é inclusivo: um item a mais para descartar o cursor.
+            extra = 1 if cursor is not None else 0
+            pagina = await data_access.query(nome, "$key", start_at=cursor, limit_to_first=JOBS_BATCH_SIZE + extra) or {}
+            pagina = {chave: filhos for chave, filhos in pagina.items() if chave != cursor}
+            if not pagina:
+                break
+
+            pares = []
+            for chave, filhos in pagina.items():
+                for filho in (filhos if isinstance(filhos, dict) else {}):
+                    pares.append((chave, filho) if nome == "agenda_membros_por_agenda" else (filho, chave))
+
+            agendas = await agendas_existentes({uid_da_agenda for uid_da_agenda, _ in pares})
+            perfis = await resolver_perfis_de_usuarios(uid_do_membro for _, uid_do_membro in pares)
+            orfaos = [(uid_da_agenda, uid_do_membro) for uid_da_agenda, uid_do_membro in pares if uid_da_agenda not in agendas or perfis.get(uid_do_membro) is None]
+
+            verificados += len(pares)
+            removidos += await remover_vinculos(orfaos)
+            cursor = next(reversed(pagina))
+            yield {"fase": nome, "cursor": cursor, "verificados": verificados, "removidos": removidos}
+        cursor = None
+
+TOMBSTONE_RETENTION_DAYS = int(os.getenv("TOMBSTONE_RETENTION_DAYS", "30"))
+
+async def podar_lapides(parametros: dict, progresso: dict):
+    # Apaga as lápides mais antigas que parametros["ate"], agenda por agenda,
+    # e guarda em agenda_tombstones_podados/{agenda} o timestamp da mais nova
+    # apagada: um /sync/agenda com cursor até ali pode ter perdido remoções e
+    # recebe a agenda inteira.
+    ate = parametros["ate"]
+    cursor = progresso.get("cursor")
+    removidas = progresso.get("removidas", 0)
+
+    agendas = sorted(await data_access.get("agenda_tombstones", shallow=True) or {})
+    for uid_da_agenda in agendas:
+        if cursor is not None and uid_da_agenda <= cursor:
+            continue
+        while True:
+            lapides = await data_access.query(f"agenda_tombstones/{uid_da_agenda}", "timestamp", end_at=ate, limit_to_first=JOBS_BATCH_SIZE) or {}
+            if not lapides:
+                break
+            await data_access.update("", {
+                **{f"agenda_tombstones/{uid_da_agenda}/{uid}": None for uid in lapides},
+                f"agenda_tombstones_podados/{uid_da_agenda}": max(lapide["timestamp"] for lapide in lapides.values()),
+            })
+            removidas += len(lapides)
+            if len(lapides) < JOBS_BATCH_SIZE:
+                break
+        cursor = uid_da_agenda
+        yield {"cursor": cursor, "removidas": removidas}
+
+fila_de_jobs = FilaDeJobs(
+    {"limpar_agenda": limpar_agenda, "limpar_usuario": limpar_usuario, "vacuum": vacuum, "podar_lapides": podar_lapides},
+    JOBS_MAX_ATTEMPTS, JOBS_RETRY_BASE_SECONDS, JOBS_LEASE_SECONDS, JOBS_TIME_BUDGET_SECONDS,
+)
+
+class OperacaoBatch(BaseModel):
+    acao: Literal["criar", "atualizar", "deletar"]
+    tipo: Literal["tarefa", "evento", "materia", "membro"]
+    uid_da_agenda: str
+    # UID do item (atualizar/deletar) ou do usuário, quando o tipo é membro.
+    uid: Optional[str] = None
+    # Mesmos parâmetros das rotas individuais (ex.: nome_da_tarefa); para
+    # membro, "role".
+    dados: dict = {}
+
+BATCH_MAX_OPERACOES = 500
+
+class NovaTarefa(BaseModel):
+    nome_da_tarefa: str
+
+class NovoEvento(BaseModel):
+    nome_do_evento: str
+
+class NovaMateria(BaseModel):
+    nome_da_matéria: str
+    nome_do_professor: Optional[str] = None
+    horario_de_inicio_da_materia: Optional[str] = None
+    horario_de_fim_da_materia: Optional[str] = None
+
 STANDARD_RESPONSES = {
     400: {"description": "Bad Request"},
     401: {"description": "Unauthorized"},
@@ -135,7 +2284,7 @@ tags_metadata = [
     },
 ]
 
-app = FastAPI(title='Cosmos API', openapi_tags=tags_metadata)
+app = FastAPI(title='Cosmos API', openapi_tags=tags_metadata, default_response_class=RespostaJSON)
 
 origins = ["*"]
 
@@ -147,22 +2296,93 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(CompressaoMiddleware, minimo=COMPRESSION_MIN_BYTES)
+
+@app.middleware("http")
+async def limitar_tamanho_do_upload(request: Request, call_next):
+    # Rejeita pelo Content-Length antes de o corpo ser lido: nenhum arquivo
+    # pode passar do maior limite por categoria. O limite da categoria do
+    # arquivo é aplicado pelo receber_upload, enquanto o corpo chega.
+    if request.url.path == "/blob/uploadFile":
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > max(PHOTO_LIMIT, VIDEO_LIMIT, DOCUMENT_LIMIT) + MULTIPART_OVERHEAD:
+            return JSONResponse(status_code=413, content={"detail": "Arquivo muito grande."})
+    return await call_next(request)
+
+@app.middleware("http")
+async def medir_requisicao(request: Request, call_next):
+    # Conta e cronometra as chamadas ao backend de cada requisição. O
+    # resultado vai no header Server-Timing, nos histogramas do /metrics e,
+    # se a requisição passar de SLOW_REQUEST_MS, no log.
+    medicoes = {}
+    token = medicoes_da_requisicao.set(medicoes)
+    inicio = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        medicoes_da_requisicao.reset(token)
+    duracao = time.perf_counter() - inicio
+
+    route = request.scope.get("route")
+    rota = route.path if route is not None else "<sem rota>"
+
+    # O header sai antes do corpo, então só cobre o que a rota fez até
+    # devolver a resposta. Numa StreamingResponse (o /getAllUsers paginado,
+    # por exemplo) as chamadas feitas durante o stream entram nos histogramas
+    # e no log quando ele termina. O SSE fica de fora disso: a conexão dura
+    # minutos e distorceria os histogramas de duração.
+    timings = [f'{categoria};dur={tempo * 1000:.1f};desc="{chamadas} chamadas"' for categoria, (chamadas, tempo) in medicoes.items()]
+    timings.append(f"total;dur={duracao * 1000:.1f}")
+    response.headers["Server-Timing"] = ", ".join(timings)
+
+    def registrar(duracao: float):
+        duracao_das_requisicoes.observar(duracao, rota=rota, metodo=request.method)
+        for categoria in ("db", "auth", "blob"):
+            chamadas, tempo = medicoes.get(categoria, (0, 0.0))
+            chamadas_ao_backend.observar(chamadas, rota=rota, categoria=categoria)
+            if chamadas:
+                duracao_no_backend.observar(tempo, rota=rota, categoria=categoria)
+
+        if duracao * 1000 >= SLOW_REQUEST_MS:
+            detalhes = "; ".join(f"{categoria}: {chamadas} chamadas, {tempo * 1000:.0f} ms" for categoria, (chamadas, tempo) in medicoes.items())
+            logger.warning("Requisição lenta: %s %s levou %.0f ms (%s)", request.method, rota, duracao * 1000, detalhes or "sem chamadas ao backend")
+
+    if response.headers.get("content-type", "").startswith("text/event-stream"):
+        registrar(duracao)
+        return response
+
+    corpo = response.body_iterator
+
+    async def medir_o_corpo():
+        try:
+            async for parte in corpo:
+                yield parte
+        finally:
+            registrar(time.perf_counter() - inicio)
+
+    response.body_iterator = medir_o_corpo()
+    return response
+
 @app.get("/")
 def read_root():
     return {"Hello": "World"}
 
 @app.get("/testFirebase", responses=STANDARD_RESPONSES)
-def testar_o_firebase():
+async def testar_o_firebase():
     try:
-        if ref.get():
+        if await data_access.get("", shallow=True):
             return {"message": "Conectado com successo ao Firebase"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Falha ao se conectar com o Firebase: {str(e)}")
 
 @app.get("/invite/{chave_de_convite_da_agenda}", responses=STANDARD_RESPONSES)
-def mandar_um_convite_para_entrar_na_turma_tipo_o_whatsapp(chave_de_convite_da_agenda: str, request: Request):
-    agenda_node = agenda_ref.order_by_child('chave_de_convite').equal_to(chave_de_convite_da_agenda)
-    agenda_data = agenda_node.get()
+async def mandar_um_convite_para_entrar_na_turma_tipo_o_whatsapp(chave_de_convite_da_agenda: str, request: Request):
+    uid_da_agenda = await resolver_convite(chave_de_convite_da_agenda)
+    agenda_data = {}
+    if uid_da_agenda is not None:
+        agenda = await data_access.get(f"agendas/{uid_da_agenda}", shallow=True)
+        if agenda:
+            agenda_data[uid_da_agenda] = agenda
 
     if not agenda_data:
         raise HTTPException(status_code=404, detail=f"Essa agenda não existe")
@@ -201,26 +2421,42 @@ def mandar_um_convite_para_entrar_na_turma_tipo_o_whatsapp(chave_de_convite_da_a
     return RedirectResponse(play_store_url)
 
 @app.get("/getAllUsers", tags=["Usuários"], responses=STANDARD_RESPONSES)
-def conseguir_todos_os_usuarios_logado_com_o_email_normal_no_firebase(api_key: str = Depends(get_api_key)):
-    users = []
-    page = auth.list_users()
-    while page:
-        for user in page.users:
-            users.append({
-                "uid": user.uid,
-                "email": user.email,
-                "passwordHash": user.password_hash,
-                "passwordSalt": user.password_salt,
-                "display_name": user.display_name,
-                "phone_number": user.phone_number or "",
-                "photo_url": user.photo_url or ""
-            })
-        page = page.get_next_page()
-    return users
+async def conseguir_todos_os_usuarios_logado_com_o_email_normal_no_firebase(formato: str = Query("json", pattern="^(json|ndjson)$"), page_token: str | None = None, max_results: int | None = Query(None, ge=1, le=1000), api_key: str = Depends(get_api_key)):
+    # Com page_token ou max_results devolve uma única página e o token da
+    # próxima, para ferramentas que buscam os usuários em fatias. Sem eles a
+    # lista inteira é transmitida página a página (array JSON ou NDJSON), sem
+    # juntar todos os usuários em memória antes de responder.
+    if page_token is not None or max_results is not None:
+        page = await data_access.list_users(page_token=page_token, max_results=max_results or 1000)
+        return RespostaJSON({
+            "users": [dados_completos_do_usuario(user) for user in page.users],
+            "proximo": page.next_page_token or None
+        })
+
+    async def gerar():
+        # Um pedaço por página do Auth.
+        primeiro = True
+        if formato == "json":
+            yield b"["
+        page = await data_access.list_users()
+        while page:
+            linhas = [orjson.dumps(dados_completos_do_usuario(user)) for user in page.users]
+            if linhas:
+                if formato == "ndjson":
+                    yield b"\n".join(linhas) + b"\n"
+                else:
+                    yield (b"" if primeiro else b",") + b",".join(linhas)
+                primeiro = False
+            page = await data_access.next_users_page(page)
+        if formato == "json":
+            yield b"]"
+
+    media_type = "application/x-ndjson" if formato == "ndjson" else "application/json"
+    return StreamingResponse(gerar(), media_type=media_type)
 
 @app.post("/add/user", tags=["Usuários"], responses=STANDARD_RESPONSES)
 async def criar_um_usuario_com_email_e_senha(email: str, password: str, display_name: str, phone_number: str | None = None, photo_url: str | None = None, api_key: str = Depends(get_api_key)):
-    user = auth.create_user(
+    user = await data_access.create_user(
         email=email,
         email_verified=False,
         phone_number=to_e164_br(phone_number),
@@ -233,16 +2469,18 @@ async def criar_um_usuario_com_email_e_senha(email: str, password: str, display_
     return {"message": 'Criado um usuário com sucesso. UID: {0}'.format(user.uid)}
 
 @app.delete("/delete/user", tags=["Usuários"], responses=STANDARD_RESPONSES)
-async def deletar_um_usuario_com_o_uid(uid_do_usuario: str, api_key: str = Depends(get_api_key)):
-    if check_uid_exists(uid_do_usuario):
-        auth.delete_user(uid_do_usuario)
-        return {"message": f'O usuário com o UID {uid_do_usuario} foi deletado com sucesso.'}
+async def deletar_um_usuario_com_o_uid(background_tasks: BackgroundTasks, uid_do_usuario: str, api_key: str = Depends(get_api_key)):
+    if await data_access.find_user(uid_do_usuario):
+        await data_access.delete_user(uid_do_usuario)
+        # Os vínculos com as agendas são removidos depois da resposta, pelo job.
+        id_do_job = await fila_de_jobs.enfileirar("limpar_usuario", {"uid_do_usuario": uid_do_usuario}, background_tasks)
+        return {"message": f'O usuário com o UID {uid_do_usuario} foi deletado com sucesso.', "job": id_do_job}
     else:
         raise HTTPException(status_code=400, detail="Este usuário não existe no banco de dados")
 
 @app.patch("/update/user", tags=["Usuários"], responses=STANDARD_RESPONSES)
 async def atualizar_os_dados_de_um_usuário(uid_do_usuario: str = Query(...), email: str = Query(None), password: str = Query(None), display_name: str = Query(None), phone_number: str = Query(None), photo_url: str = Query(None), disabled: bool = Query(None), api_key: str = Depends(get_api_key)):
-    if not check_uid_exists(uid_do_usuario):
+    if not await data_access.find_user(uid_do_usuario):
         raise HTTPException(status_code=404, detail="Este usuário não existe no banco de dados")
 
     try:
@@ -260,81 +2498,114 @@ async def atualizar_os_dados_de_um_usuário(uid_do_usuario: str = Query(...), em
         if disabled is not None:
             update_data['disabled'] = disabled
 
-        user = auth.update_user(uid_do_usuario, **update_data)
+        user = await data_access.update_user(uid_do_usuario, **update_data)
 
         return {"message": f"Usuário {user.uid} atualizado com sucesso."}
 
-    except auth.AuthError as e:
+    except BackendError as e:
         raise HTTPException(status_code=500, detail=f"Erro ao atualizar o usuário: {str(e)}")
 
 @app.get("/getAllAgendas", tags=["Agenda"], responses=STANDARD_RESPONSES)
-async def mostrar_todas_as_agendas_criadas(api_key: str = Depends(get_api_key)):
-    if agenda_ref.get() is None:
-        return {"message": 'Nenhuma agenda foi criada'}
-    else:
-        return agenda_ref.get()
+async def mostrar_todas_as_agendas_criadas(limite: int | None = Query(None, ge=1, le=1000), apos: str | None = None, shallow: bool = False, api_key: str = Depends(get_api_key)):
+    # Sem limite e sem shallow a resposta continua sendo a árvore inteira,
+    # como antes, mas lida uma vez só. Com qualquer um dos dois a resposta
+    # vem paginada por chave: {"agendas": {...}, "proximo": <cursor>}, e o
+    # cursor é passado de volta em "apos" para buscar a próxima página.
+    if limite is None and not shallow:
+        agendas = await data_access.get("agendas")
+        if agendas is None:
+            return {"message": 'Nenhuma agenda foi criada'}
+        return RespostaJSON(agendas)
+
+    if shallow:
+        # A leitura shallow de /agendas traz só os IDs; a paginação é feita
+        # aqui e apenas os campos de resumo das agendas da página são lidos.
+        ids = sorted(await data_access.get("agendas", shallow=True) or {})
+        if apos is not None:
+            ids = [agenda_id for agenda_id in ids if agenda_id > apos]
+        pagina = ids[:limite] if limite is not None else ids
+        proximo = pagina[-1] if limite is not None and len(ids) > limite else None
+        agendas = await buscar_agendas(pagina, CAMPOS_RESUMO_AGENDA)
+        return RespostaJSON({"agendas": agendas, "proximo": proximo})
+
+    # start_at é inclusivo: pede um item a mais para descartar o próprio cursor
+    # e mais um para saber se existe uma próxima página.
+    extra = 2 if apos is not None else 1
+    resultado = await data_access.query("agendas", "$key", start_at=apos, limit_to_first=limite + extra) or {}
+    agendas = [(agenda_id, agenda) for agenda_id, agenda in resultado.items() if agenda_id != apos]
+    proximo = agendas[limite - 1][0] if len(agendas) > limite else None
+    return RespostaJSON({"agendas": dict(agendas[:limite]), "proximo": proximo})
 
 @app.get("/getAllAgendasLinkedToUser", tags=["Agenda"], responses=STANDARD_RESPONSES)
-async def mostrar_todas_as_agendas_que_o_usuário_faz_parte(uid_do_responsavel: str, api_key: str = Depends(get_api_key)):
-    user_agenda_ids = agenda_membros_ref.child(uid_do_responsavel).get()
+async def mostrar_todas_as_agendas_que_o_usuário_faz_parte(request: Request, uid_do_responsavel: str, campos: list[str] | None = Query(None), api_key: str = Depends(get_api_key)):
+    if campos:
+        invalidos = set(campos) - set(CAMPOS_RESUMO_AGENDA)
+        if invalidos:
+            raise HTTPException(status_code=400, detail=f"Campos inválidos: {', '.join(sorted(invalidos))}. Use: {', '.join(CAMPOS_RESUMO_AGENDA)}")
+
+    user_agenda_ids = await data_access.get(f"agenda_membros/{uid_do_responsavel}")
 
     if not user_agenda_ids:
         raise HTTPException(status_code=404, detail="O usuário não está ligado a nenhuma agenda")
 
-    agendas = {}
-    for agenda_id in user_agenda_ids:
-        agenda_data = agenda_ref.child(agenda_id).get()
-        if agenda_data:
-            agendas[agenda_id] = agenda_data
-
-    return agendas
-
-@app.get("/getAllTarefasFromOneAgenda", tags=["Agenda"], responses=STANDARD_RESPONSES)
-async def mostrar_todas_as_tarefas_dentro_de_uma_agenda(uid_da_agenda: str, api_key: str = Depends(get_api_key)):
-    agenda_node = agenda_ref.child(uid_da_agenda).get()
-
-    if not agenda_node:
+    return resposta_com_etag(request, await buscar_agendas(user_agenda_ids, campos))
+
+async def listar_itens_da_agenda(request: Request, uid_da_agenda: str, tipo: str, desde: str | None, ate: str | None, limite: int | None, ordem: str | None):
+    # Sem filtros devolve a coleção inteira, como sempre foi. Com qualquer
+    # um deles a consulta é feita no servidor, ordenada por timestamp:
+    # desde/ate viram start_at/end_at e limite pega os primeiros (asc) ou os
+    # últimos (desc) da faixa.
+    colecao = ITENS_DA_AGENDA[tipo]["colecao"]
+
+    if desde is None and ate is None and limite is None and ordem is None:
+        agenda_node = await data_access.get(f"agendas/{uid_da_agenda}")
+        if not agenda_node:
+            raise HTTPException(status_code=404, detail=f"A agenda com UID '{uid_da_agenda}' não existe.")
+        itens = agenda_node.get(colecao)
+        if not itens:
+            raise HTTPException(status_code=404, detail=f"A agenda '{uid_da_agenda}' não possui {colecao}.")
+        return resposta_com_etag(request, itens)
+
+    if not await data_access.exists(f"agendas/{uid_da_agenda}"):
         raise HTTPException(status_code=404, detail=f"A agenda com UID '{uid_da_agenda}' não existe.")
 
-    tarefas = agenda_node.get("tarefas")
+    decrescente = ordem == "desc"
+    resultado = await data_access.query(
+        f"agendas/{uid_da_agenda}/{colecao}", "timestamp",
+        start_at=limite_de_timestamp(desde) if desde is not None else None,
+        end_at=limite_de_timestamp(ate, fim_do_dia=True) if ate is not None else None,
+        limit_to_last=limite if decrescente else None,
+        limit_to_first=None if decrescente else limite,
+    ) or {}
+    itens = list(resultado.items())
+    if decrescente:
+        itens.reverse()
+    return resposta_com_etag(request, dict(itens))
 
-    if not tarefas:
-        raise HTTPException(status_code=404, detail=f"A agenda '{uid_da_agenda}' não possui tarefas.")
+@app.get("/getAllTarefasFromOneAgenda", tags=["Agenda"], responses=STANDARD_RESPONSES)
+async def mostrar_todas_as_tarefas_dentro_de_uma_agenda(request: Request, uid_da_agenda: str, desde: str | None = None, ate: str | None = None, limite: int | None = Query(None, ge=1, le=1000), ordem: str | None = Query(None, pattern="^(asc|desc)$"), api_key: str = Depends(get_api_key)):
+    return await listar_itens_da_agenda(request, uid_da_agenda, "tarefa", desde, ate, limite, ordem)
 
-    return tarefas
+@app.get("/getAllEventosFromOneAgenda", tags=["Agenda"], responses=STANDARD_RESPONSES)
+async def mostrar_todos_os_eventos_dentro_de_uma_agenda(request: Request, uid_da_agenda: str, desde: str | None = None, ate: str | None = None, limite: int | None = Query(None, ge=1, le=1000), ordem: str | None = Query(None, pattern="^(asc|desc)$"), api_key: str = Depends(get_api_key)):
+    return await listar_itens_da_agenda(request, uid_da_agenda, "evento", desde, ate, limite, ordem)
 
 @app.get("/getAllMembrosFromOneAgenda", tags=["Agenda"], responses=STANDARD_RESPONSES)
-async def mostrar_todos_os_membros_dentro_de_uma_agenda(uid_da_agenda: str, api_key: str = Depends(get_api_key)):
-    membros_geral = agenda_membros_ref.get()
-    if not membros_geral:
-        raise HTTPException(status_code=404, detail="Não há membros vinculados a nenhuma agenda.")
-
-    membros_da_agenda = {}
-
-    for uid_usuario, agendas in membros_geral.items():
-        if uid_da_agenda in agendas:
-            role = agendas[uid_da_agenda].get("role", "Desconhecido")
-            membros_da_agenda[uid_usuario] = role
-
-    if not membros_da_agenda:
+async def mostrar_todos_os_membros_dentro_de_uma_agenda(request: Request, uid_da_agenda: str, api_key: str = Depends(get_api_key)):
+    membros = await data_access.get(f"agenda_membros_por_agenda/{uid_da_agenda}")
+    if not membros:
         raise HTTPException(status_code=404, detail=f"Nenhum membro encontrado para a agenda '{uid_da_agenda}'.")
 
-    todos_usuarios = {}
-    page = auth.list_users()
-    while page:
-        for user in page.users:
-            todos_usuarios[user.uid] = {
-                "uid": user.uid,
-                "email": user.email,
-                "display_name": user.display_name,
-                "phone_number": user.phone_number or "",
-                "photo_url": user.photo_url or ""
-            }
-        page = page.get_next_page()
+    membros_da_agenda = {
+        uid_usuario: (dados or {}).get("role", "Desconhecido")
+        for uid_usuario, dados in membros.items()
+    }
+
+    perfis = await resolver_perfis_de_usuarios(membros_da_agenda)
 
     resultado = []
     for uid, role in membros_da_agenda.items():
-        usuario_info = todos_usuarios.get(uid)
+        usuario_info = perfis.get(uid)
         if usuario_info:
             usuario_info["role"] = role
             resultado.append(usuario_info)
@@ -345,68 +2616,58 @@ async def mostrar_todos_os_membros_dentro_de_uma_agenda(uid_da_agenda: str, api_
                 "info": "Usuário não encontrado no Firebase Auth"
             })
 
-    return resultado
+    return resposta_com_etag(request, resultado)
 
 @app.post("/add/agenda", tags=["Agenda"], responses=STANDARD_RESPONSES)
 async def criar_uma_agenda(nome_agenda: str, uid_do_responsavel: str, api_key: str = Depends(get_api_key)):
-    if not check_uid_exists(uid_do_responsavel):
+    if not await data_access.find_user(uid_do_responsavel):
         raise HTTPException(status_code=401, detail="Este usuário não existe no banco de dados")
 
     uid_da_agenda = str(uuid.uuid4())
-    agenda_ref.update({
-        uid_da_agenda: {
+    chave_de_convite = generate_random_invite_key()
+    await data_access.update("", {
+        f"agendas/{uid_da_agenda}": {
             'nome_agenda': nome_agenda,
-            'chave_de_convite': generate_random_invite_key(),
+            'chave_de_convite': chave_de_convite,
             'firstCreated': timestamp_formatado(datetime.now())
-        }
-    })
-
-    agenda_membros_ref.child(uid_do_responsavel).update({
-        uid_da_agenda: {
-            "role": "admin"
-        }
+        },
+        f"agenda_por_convite/{chave_de_convite}": uid_da_agenda,
+        **caminhos_de_membro(uid_da_agenda, uid_do_responsavel, {"role": "admin"})
     })
+    convite_cache.invalidate(chave_de_convite)
 
     return {"message": f'A agenda {nome_agenda} com o UID {uid_da_agenda} foi criada com sucesso, com o usuário com o UID {uid_do_responsavel} sendo o responsável por ela'}
 
 
 @app.post("/add/agenda/membro", tags=["Agenda"], responses=STANDARD_RESPONSES)
 async def adicionar_um_membro_na_agenda_já_criada(uid_da_agenda: str, uid_do_membro: str, api_key: str = Depends(get_api_key)):
-    agenda_node = agenda_ref.child(uid_da_agenda)
-    agenda_data = agenda_node.get()
+    agenda_data = await data_access.get(f"agendas/{uid_da_agenda}", shallow=True)
 
     if not agenda_data:
         raise HTTPException(status_code=404, detail=f"A agenda com o UID {uid_da_agenda} não existe")
 
-    if not check_uid_exists(uid_do_membro):
+    user = await data_access.find_user(uid_do_membro)
+    if not user:
         raise HTTPException(status_code=401, detail="Este usuário não existe no banco de dados")
 
-    user = auth.get_user(uid_do_membro)
-
-    agenda_membros_ref.child(user.uid).update({
-        uid_da_agenda: {
-            "role": "user"
-        }
-    })
+    await data_access.update("", caminhos_de_membro(uid_da_agenda, user.uid, {"role": "user"}))
 
     return {"message": f'O membro {user.display_name} com o UID {user.uid} foi adicionado com sucesso na agenda {agenda_data["nome_agenda"]}'}
 
 
 @app.post("/add/agenda/materia", tags=["Agenda"], responses=STANDARD_RESPONSES)
 async def criar_uma_materia_na_agenda_já_criada(uid_da_agenda: str, nome_da_matéria: str, nome_do_professor: str | None = None, horario_de_inicio_da_materia: str | None = None, horario_de_fim_da_materia: str | None = None, api_key: str = Depends(get_api_key)):
-    agenda_node = agenda_ref.child(uid_da_agenda)
-    agenda_data = agenda_node.get()
-    if not agenda_data:
+    if not await data_access.exists(f"agendas/{uid_da_agenda}"):
         raise HTTPException(status_code=404, detail=f"A agenda com o UID {uid_da_agenda} não existe")
 
-    matérias_ref = agenda_node.child("matérias")
     uid = str(uuid.uuid4())
-    matérias_ref.update({
+    await data_access.update(f"agendas/{uid_da_agenda}/matérias", {
         uid: {
             'nome_matéria': nome_da_matéria,
             'professor': nome_do_professor,
             'horario_de_início': horario_de_inicio_da_materia,
-            "horário_de_fim": horario_de_fim_da_materia
+            "horário_de_fim": horario_de_fim_da_materia,
+            "timestamp": timestamp_formatado(datetime.now())
         }
     })
 
@@ -414,14 +2675,11 @@ async def criar_uma_materia_na_agenda_já_criada(uid_da_agenda: str, nome_da_mat
 
 @app.post("/add/agenda/tarefa", tags=["Agenda"], responses=STANDARD_RESPONSES)
 async def criar_uma_tarefa_na_agenda_já_criada(uid_da_agenda: str, nome_da_tarefa: str, api_key: str = Depends(get_api_key)):
-    agenda_node = agenda_ref.child(uid_da_agenda)
-    agenda_data = agenda_node.get()
-    if not agenda_data:
+    if not await data_access.exists(f"agendas/{uid_da_agenda}"):
         raise HTTPException(status_code=404, detail=f"A agenda com o UID {uid_da_agenda} não existe")
 
     uid = str(uuid.uuid4())
-    tarefa_criada = agenda_node.child("tarefas")
-    tarefa_criada.update({
+    await data_access.update(f"agendas/{uid_da_agenda}/tarefas", {
         uid: {
             'nome_da_tarefa': nome_da_tarefa,
             'timestamp': timestamp_formatado(datetime.now())
@@ -432,14 +2690,11 @@ async def criar_uma_tarefa_na_agenda_já_criada(uid_da_agenda: str, nome_da_tare
 
 @app.post("/add/agenda/evento", tags=["Agenda"], responses=STANDARD_RESPONSES)
 async def criar_um_evento_na_agenda_já_criada(uid_da_agenda: str, nome_do_evento: str, api_key: str = Depends(get_api_key)):
-    agenda_node = agenda_ref.child(uid_da_agenda)
-    agenda_data = agenda_node.get()
-    if not agenda_data:
+    if not await data_access.exists(f"agendas/{uid_da_agenda}"):
         raise HTTPException(status_code=404, detail=f"A agenda com o UID {uid_da_agenda} não existe")
 
     uid = str(uuid.uuid4())
-    evento_criado = agenda_node.child("eventos")
-    evento_criado.update({
+    await data_access.update(f"agendas/{uid_da_agenda}/eventos", {
         uid: {
             'nome_do_evento': nome_do_evento,
             'timestamp': timestamp_formatado(datetime.now())
@@ -448,66 +2703,104 @@ async def criar_um_evento_na_agenda_já_criada(uid_da_agenda: str, nome_do_event
 
     return {"message": f'O evento com o UID {uid} foi criado com sucesso.'}
 
+async def criar_itens_em_lote(uid_da_agenda: str, tipo: str, itens: list[BaseModel]) -> list[str]:
+    # Uma verificação de existência e um único update para todos os itens.
+    if not itens:
+        raise HTTPException(status_code=400, detail="Nenhum item fornecido")
+    if len(itens) > BATCH_MAX_OPERACOES:
+        raise HTTPException(status_code=413, detail=f"No máximo {BATCH_MAX_OPERACOES} itens por requisição")
+    if not await data_access.exists(f"agendas/{uid_da_agenda}"):
+        raise HTTPException(status_code=404, detail=f"A agenda com o UID {uid_da_agenda} não existe")
+
+    agora = timestamp_formatado(datetime.now())
+    novos = {str(uuid.uuid4()): montar_item(tipo, item.model_dump(), agora) for item in itens}
+    await data_access.update(f"agendas/{uid_da_agenda}/{ITENS_DA_AGENDA[tipo]['colecao']}", novos)
+    return list(novos)
+
+@app.post("/add/agenda/tarefas", tags=["Agenda"], responses=STANDARD_RESPONSES)
+async def criar_varias_tarefas_na_agenda_já_criada(uid_da_agenda: str, tarefas: list[NovaTarefa], api_key: str = Depends(get_api_key)):
+    uids = await criar_itens_em_lote(uid_da_agenda, "tarefa", tarefas)
+    return {"message": f'{len(uids)} tarefas foram criadas com sucesso.', "uids": uids}
+
+@app.post("/add/agenda/eventos", tags=["Agenda"], responses=STANDARD_RESPONSES)
+async def criar_varios_eventos_na_agenda_já_criada(uid_da_agenda: str, eventos: list[NovoEvento], api_key: str = Depends(get_api_key)):
+    uids = await criar_itens_em_lote(uid_da_agenda, "evento", eventos)
+    return {"message": f'{len(uids)} eventos foram criados com sucesso.', "uids": uids}
+
+@app.post("/add/agenda/materias", tags=["Agenda"], responses=STANDARD_RESPONSES)
+async def criar_varias_materias_na_agenda_já_criada(uid_da_agenda: str, materias: list[NovaMateria], api_key: str = Depends(get_api_key)):
+    uids = await criar_itens_em_lote(uid_da_agenda, "materia", materias)
+    return {"message": f'{len(uids)} matérias foram criadas com sucesso.', "uids": uids}
+
 @app.delete("/delete/agenda", tags=["Agenda"], responses=STANDARD_RESPONSES)
-async def deletar_uma_agenda_com_o_uid(uid_da_agenda: str, api_key: str = Depends(get_api_key)):
-    agenda_node = agenda_ref.child(uid_da_agenda)
-    agenda_data = agenda_node.get()
+async def deletar_uma_agenda_com_o_uid(background_tasks: BackgroundTasks, uid_da_agenda: str, api_key: str = Depends(get_api_key)):
+    agenda_data = await data_access.get(f"agendas/{uid_da_agenda}", shallow=True)
     if not agenda_data:
         raise HTTPException(status_code=404, detail=f"A agenda com o UID {uid_da_agenda} não existe")
 
-    agenda_node.delete()
+    # A agenda some na hora; os vínculos dos membros (agenda_membros/*/{uid}
+    # e o índice reverso, que o job usa para achá-los) saem depois da resposta.
+    caminhos = {
+        f"agendas/{uid_da_agenda}": None,
+        f"agenda_tombstones/{uid_da_agenda}": None,
+        f"agenda_tombstones_podados/{uid_da_agenda}": None,
+    }
+    chave_de_convite = agenda_data.get("chave_de_convite")
+    if chave_de_convite:
+        caminhos[f"agenda_por_convite/{chave_de_convite}"] = None
+    await data_access.update("", caminhos)
+    if chave_de_convite:
+        convite_cache.invalidate(chave_de_convite)
+    id_do_job = await fila_de_jobs.enfileirar("limpar_agenda", {"uid_da_agenda": uid_da_agenda}, background_tasks)
 
-    return {"message": f'A agenda com o UID {uid_da_agenda} foi deletada com sucesso.'}
+    return {"message": f'A agenda com o UID {uid_da_agenda} foi deletada com sucesso.', "job": id_do_job}
 
 @app.delete("/delete/agenda/membro", tags=["Agenda"], responses=STANDARD_RESPONSES)
 async def deletar_um_membro_na_agenda(uid_da_agenda: str, uid_do_membro: str, api_key: str = Depends(get_api_key)):
-    membro_node = agenda_membros_ref.child(uid_do_membro).child(uid_da_agenda)
-    membro_data = membro_node.get()
+    membro_data = await data_access.get(f"agenda_membros/{uid_do_membro}/{uid_da_agenda}")
     if not membro_data:
         raise HTTPException(status_code=404, detail=f"Esse usuário com o UID {uid_do_membro} não pertence a agenda com o UID {uid_da_agenda}")
 
-    membro_node.delete()
+    await data_access.update("", caminhos_de_membro(uid_da_agenda, uid_do_membro, None))
 
     return {"message": f'O membro com o UID {uid_do_membro} foi removido da agenda com o UID {uid_da_agenda}'}
 
 @app.delete("/delete/agenda/materia", tags=["Agenda"], responses=STANDARD_RESPONSES)
 async def deletar_uma_materia_com_o_uid(uid_da_agenda: str, uid_da_materia: str, api_key: str = Depends(get_api_key)):
-    matéria_node = agenda_ref.child(uid_da_agenda).child("matérias").child(uid_da_materia)
-    matéria_data = matéria_node.get()
+    matéria_path = f"agendas/{uid_da_agenda}/matérias/{uid_da_materia}"
+    matéria_data = await data_access.get(matéria_path)
     if not matéria_data:
         raise HTTPException(status_code=404, detail=f"A matéria com o UID {uid_da_materia} na agenda {uid_da_agenda} não existe")
 
-    matéria_node.delete()
+    await data_access.update("", caminhos_de_remocao(uid_da_agenda, "materia", uid_da_materia, timestamp_formatado(datetime.now())))
 
     return {"message": f'A matéria com o UID {uid_da_materia} foi deletada com sucesso.'}
 
 @app.delete("/delete/agenda/tarefa", tags=["Agenda"], responses=STANDARD_RESPONSES)
 async def deletar_uma_tarefa_com_o_uid(uid_da_agenda: str, uid_da_tarefa: str, api_key: str = Depends(get_api_key)):
-    tarefa_node = agenda_ref.child(uid_da_agenda).child("tarefas").child(uid_da_tarefa)
-    tarefa_data = tarefa_node.get()
+    tarefa_path = f"agendas/{uid_da_agenda}/tarefas/{uid_da_tarefa}"
+    tarefa_data = await data_access.get(tarefa_path)
     if not tarefa_data:
         raise HTTPException(status_code=404, detail=f"A tarefa com o UID {uid_da_tarefa} na agenda {uid_da_agenda} não existe")
 
-    tarefa_node.delete()
+    await data_access.update("", caminhos_de_remocao(uid_da_agenda, "tarefa", uid_da_tarefa, timestamp_formatado(datetime.now())))
 
     return {"message": f'A tarefa com o UID {uid_da_tarefa} foi deletada com sucesso.'}
 
 @app.delete("/delete/agenda/evento", tags=["Agenda"], responses=STANDARD_RESPONSES)
 async def deletar_um_evento_com_o_uid(uid_da_agenda: str, uid_do_evento: str, api_key: str = Depends(get_api_key)):
-    evento_node = agenda_ref.child(uid_da_agenda).child("eventos").child(uid_do_evento)
-    evento_data = evento_node.get()
+    evento_path = f"agendas/{uid_da_agenda}/eventos/{uid_do_evento}"
+    evento_data = await data_access.get(evento_path)
     if not evento_data:
         raise HTTPException(status_code=404, detail=f"O evento com o UID {uid_do_evento} na agenda {uid_da_agenda} não existe")
 
-    evento_node.delete()
+    await data_access.update("", caminhos_de_remocao(uid_da_agenda, "evento", uid_do_evento, timestamp_formatado(datetime.now())))
 
     return {"message": f'O evento com o UID {uid_do_evento} foi deletado com sucesso.'}
 
 @app.patch("/update/agenda", tags=["Agenda"], responses=STANDARD_RESPONSES)
 async def atualizar_os_dados_da_agenda(uid_da_agenda: str = Query(...), nome_agenda: str = Query(None), uid_do_responsavel: str = Query(None), api_key: str = Depends(get_api_key)):
-    agenda_node = agenda_ref.child(uid_da_agenda)
-    agenda_data = agenda_node.get()
-    if not agenda_data:
+    if not await data_access.exists(f"agendas/{uid_da_agenda}"):
         raise HTTPException(status_code=404, detail=f"A agenda com o UID {uid_da_agenda} não existe")
 
     update_data = {}
@@ -519,15 +2812,15 @@ async def atualizar_os_dados_da_agenda(uid_da_agenda: str = Query(...), nome_age
     if not update_data:
         raise HTTPException(status_code=400, detail="Nenhum dado fornecido para atualização")
 
-    agenda_node.update(update_data)
+    await data_access.update(f"agendas/{uid_da_agenda}", update_data)
 
     return {"message": "Agenda atualizada com sucesso", "dados": update_data}
 
 @app.patch("/update/agenda/materia", tags=["Agenda"], responses=STANDARD_RESPONSES)
 async def atualizar_os_dados_da_agenda(uid_da_agenda: str = Query(...), uid_da_materia: str = Query(...), nome_da_matéria: str = Query(None), nome_do_professor: str = Query(None), horario_de_inicio_da_materia: str = Query(None), horario_de_fim_da_materia: str = Query(None), api_key: str = Depends(get_api_key)):
-    agenda_node = agenda_ref.child(uid_da_agenda).child("matérias").child(uid_da_materia)
-    agenda_data = agenda_node.get()
-    if not matéria_data:
+    agenda_node = f"agendas/{uid_da_agenda}/matérias/{uid_da_materia}"
+    agenda_data = await data_access.get(agenda_node)
+    if not agenda_data:
         raise HTTPException(status_code=404, detail=f"A matéria com o UID {uid_da_materia} na agenda {uid_da_agenda} não existe")
 
     update_data = {}
@@ -539,19 +2832,21 @@ async def atualizar_os_dados_da_agenda(uid_da_agenda: str = Query(...), uid_da_m
         update_data["horario_de_início"] = horario_de_inicio_da_materia
     if horario_de_fim_da_materia is not None:
         update_data["horario_de_fim"] = horario_de_fim_da_materia
+    if update_data:
+        update_data["timestamp"] = timestamp_formatado(datetime.now())
 
     if not update_data:
         raise HTTPException(status_code=400, detail="Nenhum dado fornecido para atualização")
 
-    agenda_node.update(update_data)
+    await data_access.update(agenda_node, update_data)
 
     return {"message": "Agenda atualizada com sucesso", "dados": update_data}
 
 @app.patch("/update/agenda/tarefa", tags=["Agenda"], responses=STANDARD_RESPONSES)
 async def atualizar_os_dados_da_agenda(uid_da_agenda: str = Query(...), uid_da_tarefa: str = Query(...), nome_da_tarefa: str = Query(None), api_key: str = Depends(get_api_key)):
-    agenda_node = agenda_ref.child(uid_da_agenda).child("tarefas").child(uid_da_tarefa)
-    agenda_data = agenda_node.get()
-    if not matéria_data:
+    agenda_node = f"agendas/{uid_da_agenda}/tarefas/{uid_da_tarefa}"
+    agenda_data = await data_access.get(agenda_node)
+    if not agenda_data:
         raise HTTPException(status_code=404, detail=f"A tarefa com o UID {uid_da_tarefa} na agenda {uid_da_agenda} não existe")
 
     timestamp_definido = timestamp_formatado(datetime.now())
@@ -565,21 +2860,21 @@ async def atualizar_os_dados_da_agenda(uid_da_agenda: str = Query(...), uid_da_t
     if not update_data:
         raise HTTPException(status_code=400, detail="Nenhum dado fornecido para atualização")
 
-    agenda_node.update(update_data)
+    await data_access.update(agenda_node, update_data)
 
     return {"message": "Agenda atualizada com sucesso", "dados": update_data}
 
 @app.patch("/update/agenda/evento", tags=["Agenda"], responses=STANDARD_RESPONSES)
 async def atualizar_os_dados_da_agenda(uid_da_agenda: str = Query(...), uid_do_evento: str = Query(...), nome_do_evento: str = Query(None), api_key: str = Depends(get_api_key)):
-    agenda_node = agenda_ref.child(uid_da_agenda).child("eventos").child(uid_do_evento)
-    agenda_data = agenda_node.get()
-    if not matéria_data:
+    agenda_node = f"agendas/{uid_da_agenda}/eventos/{uid_do_evento}"
+    agenda_data = await data_access.get(agenda_node)
+    if not agenda_data:
         raise HTTPException(status_code=404, detail=f"O evento com o UID {uid_do_evento} na agenda {uid_da_agenda} não existe")
 
     timestamp_definido = timestamp_formatado(datetime.now())
 
     update_data = {}
-    if nome_da_tarefa is not None:
+    if nome_do_evento is not None:
         update_data["nome_do_evento"] = nome_do_evento
     if timestamp_definido is not None:
         update_data["timestamp"] = timestamp_definido
@@ -587,37 +2882,414 @@ async def atualizar_os_dados_da_agenda(uid_da_agenda: str = Query(...), uid_do_e
     if not update_data:
         raise HTTPException(status_code=400, detail="Nenhum dado fornecido para atualização")
 
-    agenda_node.update(update_data)
+    await data_access.update(agenda_node, update_data)
 
     return {"message": "Agenda atualizada com sucesso", "dados": update_data}
 
-@app.get("/blob/getAll", tags=["S3"], responses=STANDARD_RESPONSES)
-def list_all_blobs(api_key: str = Depends(get_api_key)):
-    return vercel_blob.list()
-
-@app.post("/blob/uploadFile", tags=["S3"], responses=STANDARD_RESPONSES)
-async def upload_file(file: UploadFile = File(...), api_key: str = Depends(get_api_key)):
-    content = await file.read()
-    category = get_file_category(file.content_type)
-    size_limit = get_size_limit(category)
-    if category == "unknown":
-        raise HTTPException(status_code=400, detail="Tipo de arquivo não suportado.")
-    if len(content) > size_limit:
-        raise HTTPException(
-            status_code=413,
-            detail=f"Arquivo do tipo {category.capitalize()} muito grande. Tamanho máximo: {size_limit // (1024**2)} MB"
-        )
-    resp = vercel_blob.put(file.filename, content, verbose=False)
+@app.get("/stream/agenda", tags=["Agenda"], responses={**STANDARD_RESPONSES, 503: {"description": "Service Unavailable"}})
+async def acompanhar_uma_agenda(request: Request, uid_da_agenda: str, api_key: str = Depends(get_api_key)):
+    # Server-Sent Events com as mudanças da agenda. Cada evento diz o que
+    # mudou; o cliente usa o /sync/agenda com o seu cursor para buscar o
+    # resto. Se a conexão cair, o EventSource reconecta sozinho.
+    if not await data_access.exists(f"agendas/{uid_da_agenda}"):
+        raise HTTPException(status_code=404, detail=f"A agenda com o UID {uid_da_agenda} não existe")
+    try:
+        fila = await canal_de_agendas.assinar(uid_da_agenda)
+    except CanalLotado:
+        raise HTTPException(status_code=503, detail="Limite de conexões atingido, tente de novo mais tarde", headers={"Retry-After": "30"})
+
+    async def eventos():
+        try:
+            yield "retry: 5000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    notificacao = await asyncio.wait_for(fila.get(), timeout=SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+                    continue
+                if notificacao is None:
+                    break
+                yield f"event: {notificacao['acao']}\ndata: {json.dumps(notificacao, ensure_ascii=False)}\n\n"
+        finally:
+            await canal_de_agendas.cancelar(uid_da_agenda, fila)
+
+    return StreamingResponse(eventos(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/sync/agenda", tags=["Agenda"], responses=STANDARD_RESPONSES)
+async def sincronizar_uma_agenda(uid_da_agenda: str, cursor: str | None = None, api_key: str = Depends(get_api_key)):
+    # Devolve só o que mudou desde o cursor (o maior timestamp que o cliente
+    # já recebeu), com consultas por faixa de timestamp em cada coleção e nas
+    # lápides. start_at é inclusivo: itens com o mesmo timestamp do cursor
+    # voltam de novo, então o cliente deve aplicar tudo como upsert. Sem
+    # cursor, devolve a agenda inteira. As lápides são podadas depois de
+    # TOMBSTONE_RETENTION_DAYS: se alguma apagada era mais nova que o cursor,
+    # o cliente pode ter perdido remoções, e a resposta é a agenda inteira
+    # com "recarregar": true, para ele descartar o que tem.
+    leituras = [data_access.exists(f"agendas/{uid_da_agenda}")]
+    if cursor is not None:
+        leituras.append(data_access.get(f"agenda_tombstones_podados/{uid_da_agenda}"))
+    existe, *podado_ate = await asyncio.gather(*leituras)
+    if not existe:
+        raise HTTPException(status_code=404, detail=f"A agenda com o UID {uid_da_agenda} não existe")
+
+    recarregar = bool(podado_ate) and podado_ate[0] is not None and cursor <= podado_ate[0]
+    if recarregar:
+        cursor = None
+
+    colecoes = [spec["colecao"] for spec in ITENS_DA_AGENDA.values()]
+    consultas = [data_access.query(f"agendas/{uid_da_agenda}/{colecao}", "timestamp", start_at=cursor) for colecao in colecoes]
+    if cursor is not None:
+        consultas.append(data_access.query(f"agenda_tombstones/{uid_da_agenda}", "timestamp", start_at=cursor))
+    resultados = [dict(resultado or {}) for resultado in await asyncio.gather(*consultas)]
+
+    resposta = dict(zip(colecoes, resultados))
+    resposta["removidos"] = resultados[len(colecoes)] if cursor is not None else {}
+
+    timestamps = [
+        item["timestamp"]
+        for itens in resultados for item in itens.values()
+        if isinstance(item, dict) and item.get("timestamp")
+    ]
+    resposta["cursor"] = max(timestamps, default=cursor)
+    if recarregar:
+        resposta["recarregar"] = True
+    return resposta
+
+@app.post("/batch", tags=["Agenda"], responses=STANDARD_RESPONSES)
+async def aplicar_operacoes_em_lote(operacoes: list[OperacaoBatch], api_key: str = Depends(get_api_key)):
+    # Valida todas as operações e grava todas num único update multi-path
+    # (atômico no Realtime Database). Se alguma for inválida nada é gravado
+    # e a resposta traz o erro de cada uma.
+    if not operacoes:
+        raise HTTPException(status_code=400, detail="Nenhuma operação fornecida")
+    if len(operacoes) > BATCH_MAX_OPERACOES:
+        raise HTTPException(status_code=413, detail=f"No máximo {BATCH_MAX_OPERACOES} operações por lote")
+
+    agora = timestamp_formatado(datetime.now())
+    erros = {}
+    resultados = []
+    verificacoes = []
+
+    for indice, operacao in enumerate(operacoes):
+        resultados.append({"indice": indice, "acao": operacao.acao, "tipo": operacao.tipo, "uid": operacao.uid})
+        if operacao.tipo == "membro":
+            if not operacao.uid:
+                erros[indice] = "uid do membro é obrigatório"
+            elif operacao.acao == "atualizar" and operacao.dados.get("role") is None:
+                erros[indice] = "Nenhum dado fornecido para atualização"
+            elif operacao.acao != "deletar" and operacao.dados.get("role", "user") not in ("user", "admin"):
+                erros[indice] = "role deve ser 'user' ou 'admin'"
+            elif operacao.acao == "criar":
+                verificacoes.append((indice, "usuario", operacao.uid))
+            else:
+                verificacoes.append((indice, "caminho", f"agenda_membros/{operacao.uid}/{operacao.uid_da_agenda}"))
+            continue
+
+        spec = ITENS_DA_AGENDA[operacao.tipo]
+        desconhecidos = set(operacao.dados) - set(spec["campos"])
+        if desconhecidos:
+            erros[indice] = f"Campos desconhecidos: {', '.join(sorted(desconhecidos))}"
+        elif operacao.acao == "criar":
+            if operacao.uid:
+                erros[indice] = "o uid de um item novo é gerado pela API"
+            elif not operacao.dados.get(spec["obrigatorio"]):
+                erros[indice] = f"{spec['obrigatorio']} é obrigatório"
+            else:
+                resultados[indice]["uid"] = str(uuid.uuid4())
+        elif not operacao.uid:
+            erros[indice] = "uid do item é obrigatório"
+        elif operacao.acao == "atualizar" and not any(valor is not None for valor in operacao.dados.values()):
+            erros[indice] = "Nenhum dado fornecido para atualização"
+        else:
+            verificacoes.append((indice, "caminho", f"agendas/{operacao.uid_da_agenda}/{spec['colecao']}/{operacao.uid}"))
+
+    # Consultas ao banco em paralelo: cada agenda citada uma vez, mais os
+    # itens a atualizar/deletar e os usuários a adicionar.
+    agendas = list(dict.fromkeys(operacao.uid_da_agenda for operacao in operacoes))
+    semaforo = asyncio.Semaphore(FAN_OUT_LIMIT)
+
+    async def verificar(tipo, alvo):
+        async with semaforo:
+            if tipo == "usuario":
+                return await data_access.find_user(alvo) is not None
+            return await data_access.exists(alvo)
+
+    existe = await asyncio.gather(
+        *(verificar("caminho", f"agendas/{agenda}") for agenda in agendas),
+        *(verificar(tipo, alvo) for _, tipo, alvo in verificacoes),
+    )
+    agenda_existe = dict(zip(agendas, existe))
+    for (indice, tipo, _), ok in zip(verificacoes, existe[len(agendas):]):
+        if not ok and indice not in erros:
+            erros[indice] = "Este usuário não existe no banco de dados" if tipo == "usuario" else "Item não encontrado"
+
+    caminhos = {}
+    for indice, operacao in enumerate(operacoes):
+        if not agenda_existe[operacao.uid_da_agenda]:
+            erros[indice] = f"A agenda com o UID {operacao.uid_da_agenda} não existe"
+        if indice in erros:
+            continue
+
+        uid = resultados[indice]["uid"]
+        if operacao.tipo == "membro":
+            # Só a criação tem role padrão; o atualizar exige o role novo.
+            if operacao.acao == "deletar":
+                valor = None
+            elif operacao.acao == "criar":
+                valor = {"role": operacao.dados.get("role", "user")}
+            else:
+                valor = {"role": operacao.dados["role"]}
+            novos = caminhos_de_membro(operacao.uid_da_agenda, uid, valor)
+        else:
+            base = f"agendas/{operacao.uid_da_agenda}/{ITENS_DA_AGENDA[operacao.tipo]['colecao']}/{uid}"
+            if operacao.acao == "criar":
+                novos = {base: montar_item(operacao.tipo, operacao.dados, agora)}
+            elif operacao.acao == "atualizar":
+                item = montar_item(operacao.tipo, operacao.dados, agora, parcial=True)
+                novos = {f"{base}/{campo}": valor for campo, valor in item.items()}
+            else:
+                novos = caminhos_de_remocao(operacao.uid_da_agenda, operacao.tipo, uid, agora)
+
+        # O update multi-path recusa caminhos em que um contém o outro.
+        if any(caminhos_relacionados(novo, caminho) for novo in novos for caminho in caminhos):
+            erros[indice] = "Conflita com outra operação do lote sobre o mesmo item"
+            continue
+        caminhos.update(novos)
+
+    if erros:
+        for indice, resultado in enumerate(resultados):
+            if operacoes[indice].acao == "criar" and operacoes[indice].tipo != "membro":
+                resultado["uid"] = None
+            resultado["status"] = "erro" if indice in erros else "nao_aplicada"
+            if indice in erros:
+                resultado["erro"] = erros[indice]
+        raise HTTPException(status_code=400, detail={"message": "Nenhuma operação foi aplicada", "resultados": resultados})
+
+    await data_access.update("", caminhos)
+
+    for resultado in resultados:
+        resultado["status"] = "ok"
+    return {"message": f"{len(operacoes)} operações aplicadas com sucesso", "resultados": resultados}
+
+@app.get("/cache/stats", responses=STANDARD_RESPONSES)
+async def estatisticas_do_cache(api_key: str = Depends(get_api_key)):
     return {
+        "agendas": agenda_cache.stats(),
+        "convites": convite_cache.stats(),
+        "usuarios": user_cache.stats(),
+        "etags": {**etag_cache.stats(), "nao_modificados": data_access.nao_modificados},
+        "single_flight": single_flight.stats(),
+    }
+
+@app.get("/metrics", responses=STANDARD_RESPONSES)
+async def metricas(api_key: str = Depends(get_api_key)):
+    corpo = "\n".join(h.exportar() for h in (duracao_das_requisicoes, duracao_no_backend, chamadas_ao_backend))
+    stream = canal_de_agendas.stats()
+    jobs = fila_de_jobs.stats()
+    corpo += (
+        "\n# HELP cosmos_sse_subscribers Assinantes conectados ao /stream/agenda."
+        "\n# TYPE cosmos_sse_subscribers gauge"
+        f"\ncosmos_sse_subscribers {stream['assinantes']}"
+        "\n# HELP cosmos_sse_listeners Agendas com listener aberto no banco."
+        "\n# TYPE cosmos_sse_listeners gauge"
+        f"\ncosmos_sse_listeners {stream['agendas']}"
+        "\n# HELP cosmos_singleflight_calls_total Leituras no banco e no Auth de fato disparadas pelo single-flight."
+        "\n# TYPE cosmos_singleflight_calls_total counter"
+        f"\ncosmos_singleflight_calls_total {single_flight.calls}"
+        "\n# HELP cosmos_singleflight_coalesced_total Leituras que pegaram carona numa chamada igual em andamento."
+        "\n# TYPE cosmos_singleflight_coalesced_total counter"
+        f"\ncosmos_singleflight_coalesced_total {single_flight.coalesced}"
+        "\n# HELP cosmos_jobs_completed_total Jobs concluídos por este processo."
+        "\n# TYPE cosmos_jobs_completed_total counter"
+        f"\ncosmos_jobs_completed_total {jobs['concluidos']}"
+        "\n# HELP cosmos_jobs_failed_total Jobs que esgotaram as tentativas neste processo."
+        "\n# TYPE cosmos_jobs_failed_total counter"
+        f"\ncosmos_jobs_failed_total {jobs['falhas']}"
+    )
+    return PlainTextResponse(corpo + "\n", media_type="text/plain; version=0.0.4")
+
+@app.post("/admin/backfill/membrosPorAgenda", tags=["Agenda"], responses=STANDARD_RESPONSES)
+async def reconstruir_o_indice_de_membros_por_agenda(api_key: str = Depends(get_api_key)):
+    # Migração única: monta agenda_membros_por_agenda a partir dos vínculos
+    # já existentes em agenda_membros. Pode ser rodada de novo sem problema.
+    membros_geral = await data_access.get("agenda_membros")
+    if not membros_geral:
+        return {"message": "Não há membros vinculados a nenhuma agenda.", "vinculos": 0}
+
+    caminhos = {}
+    for uid_usuario, agendas in membros_geral.items():
+        for uid_da_agenda, dados in (agendas or {}).items():
+            caminhos[f"agenda_membros_por_agenda/{uid_da_agenda}/{uid_usuario}"] = dados
+
+    itens = list(caminhos.items())
+    for inicio in range(0, len(itens), 500):
+        await data_access.update("", dict(itens[inicio:inicio + 500]))
+
+    return {"message": "Índice de membros por agenda reconstruído com sucesso.", "vinculos": len(itens)}
+
+@app.post("/admin/backfill/convites", tags=["Agenda"], responses=STANDARD_RESPONSES)
+async def reconstruir_o_indice_de_convites(api_key: str = Depends(get_api_key)):
+    # Migração única: grava agenda_por_convite para as agendas já existentes.
+    agendas = await data_access.get("agendas")
+    if not agendas:
+        return {"message": "Nenhuma agenda foi criada", "convites": 0}
+
+    caminhos = {
+        f"agenda_por_convite/{agenda['chave_de_convite']}": uid_da_agenda
+        for uid_da_agenda, agenda in agendas.items()
+        if isinstance(agenda, dict) and agenda.get("chave_de_convite")
+    }
+    itens = list(caminhos.items())
+    for inicio in range(0, len(itens), 500):
+        await data_access.update("", dict(itens[inicio:inicio + 500]))
+    convite_cache.clear()
+
+    return {"message": "Índice de convites reconstruído com sucesso.", "convites": len(itens)}
+
+@app.post("/admin/vacuum", tags=["Agenda"], responses=STANDARD_RESPONSES)
+async def remover_vinculos_orfaos(background_tasks: BackgroundTasks, api_key: str = Depends(get_api_key)):
+    # Procura, depois da resposta, vínculos de membros com agendas ou
+    # usuários que não existem mais. O andamento fica no /jobs/{id}; o que
+    # não couber no tempo desta requisição continua no /admin/jobs/processar.
+    id_do_job = await fila_de_jobs.enfileirar("vacuum", {}, background_tasks)
+    return {"message": "Limpeza dos vínculos órfãos iniciada.", "job": id_do_job}
+
+@app.get("/admin/jobs/processar", tags=["Agenda"], responses=STANDARD_RESPONSES)
+async def processar_os_jobs_pendentes(autorizado: None = Depends(autorizar_cron)):
+    # Chamado pelo Vercel Cron (veja o vercel.json): continua os jobs que não
+    # terminaram na requisição que os criou, os que falharam e esperam a
+    # próxima tentativa e os de execuções que morreram no meio.
+    return await fila_de_jobs.processar_pendentes()
+
+@app.get("/admin/jobs/podarLapides", tags=["Agenda"], responses=STANDARD_RESPONSES)
+async def podar_as_lapides_antigas(background_tasks: BackgroundTasks, autorizado: None = Depends(autorizar_cron)):
+    # Chamado uma vez por dia pelo Vercel Cron.
+    ate = timestamp_formatado(datetime.now() - timedelta(days=TOMBSTONE_RETENTION_DAYS))
+    id_do_job = await fila_de_jobs.enfileirar("podar_lapides", {"ate": ate}, background_tasks)
+    return {"message": f"Poda das lápides anteriores a {ate} iniciada.", "job": id_do_job}
+
+@app.get("/jobs/{id_do_job}", responses=STANDARD_RESPONSES)
+async def mostrar_o_andamento_de_um_job(id_do_job: str, api_key: str = Depends(get_api_key)):
+    job = await data_access.get(f"jobs/{id_do_job}")
+    if not job:
+        raise HTTPException(status_code=404, detail=f"O job com o ID {id_do_job} não existe")
+    return {"id": id_do_job, **job}
+
+@app.get("/blob/getAll", tags=["S3"], responses=STANDARD_RESPONSES)
+async def list_all_blobs(api_key: str = Depends(get_api_key)):
+    return RespostaJSON(await data_access.blob_list())
+
+async def enviar_para_o_blob(file: UploadFile, sha256: str, total: int) -> tuple[dict, bool]:
+    # Lê o arquivo em partes de UPLOAD_CHUNK_SIZE, sempre com uma parte de
+    # antecedência para saber qual é a última. Arquivos de uma parte só vão
+    # num put simples; os maiores vão em multipart, parte por parte, então
+    # no máximo duas partes ficam em memória por upload. Devolve a entrada do
+    # índice e se ela acabou sendo a de outro upload simultâneo.
+    await file.seek(0)
+    upload = None
+    parts = []
+    pendente = await file.read(UPLOAD_CHUNK_SIZE)
+    while True:
+        proximo = await file.read(UPLOAD_CHUNK_SIZE)
+        if not proximo:
+            break
+        if upload is None:
+            upload = await data_access.blob_create_multipart(file.filename)
+        parts.append(await data_access.blob_upload_part(upload, len(parts) + 1, pendente))
+        pendente = proximo
+
+    if upload is None:
+        resp = await data_access.blob_put(file.filename, pendente, verbose=False)
+    else:
+        parts.append(await data_access.blob_upload_part(upload, len(parts) + 1, pendente))
+        resp = await data_access.blob_complete_multipart(upload, parts)
+
+    entrada = await registrar_blob(sha256, resp.get("url"), file.filename, total)
+    return entrada, entrada["url"] != resp.get("url")
+
+# O corpo é lido pela própria rota (receber_upload), então o formulário é
+# descrito aqui só para a documentação.
+FORMULARIO_DE_UPLOAD = {
+    "requestBody": {
+        "required": True,
+        "content": {"multipart/form-data": {"schema": {
+            "type": "object",
+            "required": ["file"],
+            "properties": {"file": {"type": "string", "format": "binary"}},
+        }}},
+    }
+}
+
+@app.post("/blob/uploadFile", tags=["S3"], responses=STANDARD_RESPONSES, openapi_extra=FORMULARIO_DE_UPLOAD)
+async def upload_file(request: Request, background_tasks: BackgroundTasks, variantes: str = Query(IMAGE_VARIANTS_MODE, pattern="^(nenhuma|sincrona|adiada)$"), api_key: str = Depends(get_api_key)):
+    file, category, sha256, total = await receber_upload(request)
+    try:
+        return await processar_upload(background_tasks, file, category, sha256, total, variantes)
+    finally:
+        await file.close()
+
+async def processar_upload(background_tasks: BackgroundTasks, file: UploadFile, category: str, sha256: str, total: int, variantes: str) -> dict:
+    # O conteúdo só vai para o Blob se ainda não estiver lá.
+    entrada = await reutilizar_blob(sha256)
+    if entrada:
+        deduplicado = True
+    else:
+        entrada, deduplicado = await enviar_para_o_blob(file, sha256, total)
+
+    resposta = {
         "filename": file.filename,
         "category": category,
-        "url": resp.get("url")
+        "url": entrada["url"],
+        "sha256": sha256,
+        "deduplicado": deduplicado
     }
 
+    # Variantes das fotos: "sincrona" espera por elas, "adiada" gera depois
+    # de responder (BackgroundTasks) e "nenhuma" não gera.
+    if category == "photo" and variantes != "nenhuma":
+        # Um reenvio do mesmo conteúdo não gera de novo: usa as variantes
+        # prontas, espera as que estão sendo geradas e não insiste numa
+        # imagem que acabou de falhar. O /blob/variantes mostra o resultado.
+        estado, atual = ("prontas", entrada) if entrada.get("variantes") else await reservar_variantes(sha256)
+        if estado == "prontas":
+            resposta["variantes"] = atual["variantes"]
+        elif estado == "reservado":
+            await file.seek(0)
+            dados = await file.read()
+            if variantes == "sincrona":
+                resposta["variantes"] = await criar_variantes(sha256, entrada["pathname"], dados)
+            else:
+                background_tasks.add_task(criar_variantes, sha256, entrada["pathname"], dados)
+                resposta["variantes"] = None
+                resposta["variantes_pendentes"] = True
+        else:
+            resposta["variantes"] = None
+            resposta["variantes_pendentes"] = estado == "gerando"
+
+    return resposta
+
+@app.get("/blob/variantes", tags=["S3"], responses=STANDARD_RESPONSES)
+async def mostrar_as_variantes_de_uma_foto(url: str, api_key: str = Depends(get_api_key)):
+    # Para o cliente buscar as variantes geradas depois da resposta do
+    # upload (modo "adiada"). estado: "prontas", "gerando", "falhou" ou
+    # "nenhuma" (enviada sem variantes).
+    sha256 = await data_access.get(f"blobs_por_url/{chave_do_blob(url)}")
+    entrada = await data_access.get(f"blobs_por_hash/{sha256}") if sha256 else None
+    if not blob_ativo(entrada):
+        raise HTTPException(status_code=404, detail="Nenhum arquivo enviado com essa URL.")
+
+    if entrada.get("variantes"):
+        estado = "prontas"
+    else:
+        estado = entrada.get("variantes_estado", "nenhuma")
+    return {"url": url, "sha256": sha256, "estado": estado, "variantes": entrada.get("variantes")}
+
 @app.delete("/blob/deleteFile", tags=["S3"], responses=STANDARD_RESPONSES)
 async def delete_blob(url: str, api_key: str = Depends(get_api_key)):
     try:
-        vercel_blob.delete(url)
+        referencias = await liberar_blob(url)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
-    return {"deleted": url}
+    return {"deleted": url, "referencias_restantes": referencias}
@@ -0,0 +1,152 @@
+"""Benchmark de carga da API, sem rede.
+
+Roda o app do api/main.py em processo com o InMemoryBackend
+(COSMOS_BACKEND=memory) e dispara requisições por um cliente ASGI, com
+concorrência fixa. A latência injetada em cada chamada ao backend simula os
+round trips ao Firebase/Vercel, então o que aparece aqui é quantas chamadas
+cada rota faz e o quanto elas andam em paralelo, não a velocidade do banco.
+
+Cenários: resolução de convite, listagem de agendas (paginada e do usuário),
+listagem de membros e criação de tarefas em lote. Para cada um imprime
+requisições por segundo e as latências p50/p95/p99.
+
+Uso:
+    python benchmarks/bench_api.py
+    python benchmarks/bench_api.py --latencia-ms 20 --requisicoes 500 --concorrencia 32
+    python benchmarks/bench_api.py --sem-cache --cenarios convite membros
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+API_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api")
+
+CENARIOS = ("convite", "agendas", "agendas_do_usuario", "membros", "tarefas_em_lote")
+
+
+def percentil(valores: list, p: float) -> float:
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, max(0, round(p / 100 * len(ordenados)) - 1))
+    return ordenados[indice]
+
+
+async def popular(client, main, args) -> dict:
+    # Usuários direto no backend; agendas e membros pelas rotas da API, para
+    # que os índices (convites, membros por agenda) fiquem como em produção.
+    backend = main.data_access.backend
+    uids = [backend.create_user(uid=f"user{i:05d}", email=f"user{i}@example.com", display_name=f"Usuário {i}").uid for i in range(args.usuarios)]
+
+    for i in range(args.agendas):
+        resposta = await client.post("/add/agenda", params={"nome_agenda": f"Agenda {i}", "uid_do_responsavel": uids[i % len(uids)]})
+        resposta.raise_for_status()
+
+    agendas = sorted(backend.get("agendas", shallow=True) or {})
+    for uid_da_agenda in agendas:
+        membros = backend.get(f"agenda_membros_por_agenda/{uid_da_agenda}") or {}
+        for uid_do_membro in random.sample(uids, min(args.membros, len(uids))):
+            if uid_do_membro not in membros:
+                resposta = await client.post("/add/agenda/membro", params={"uid_da_agenda": uid_da_agenda, "uid_do_membro": uid_do_membro})
+                resposta.raise_for_status()
+
+    chaves = [backend.get(f"agendas/{uid_da_agenda}/chave_de_convite") for uid_da_agenda in agendas]
+    com_agenda = sorted(backend.get("agenda_membros", shallow=True) or {})
+    return {"uids": com_agenda, "agendas": agendas, "chaves": chaves}
+
+
+def requisicao(cenario: str, dados: dict, args):
+    if cenario == "convite":
+        return "GET", f"/invite/{random.choice(dados['chaves'])}", {}, None
+    if cenario == "agendas":
+        return "GET", "/getAllAgendas", {"limite": 50}, None
+    if cenario == "agendas_do_usuario":
+        return "GET", "/getAllAgendasLinkedToUser", {"uid_do_responsavel": random.choice(dados["uids"])}, None
+    if cenario == "membros":
+        return "GET", "/getAllMembrosFromOneAgenda", {"uid_da_agenda": random.choice(dados["agendas"])}, None
+    tarefas = [{"nome_da_tarefa": f"Tarefa {i}"} for i in range(args.tarefas_por_lote)]
+    return "POST", "/add/agenda/tarefas", {"uid_da_agenda": random.choice(dados["agendas"])}, tarefas
+
+
+async def rodar_cenario(client, cenario: str, dados: dict, args) -> dict:
+    latencias = []
+    erros = 0
+    restantes = args.requisicoes
+
+    async def trabalhador():
+        nonlocal restantes, erros
+        while restantes > 0:
+            restantes -= 1
+            metodo, url, params, corpo = requisicao(cenario, dados, args)
+            inicio = time.perf_counter()
+            resposta = await client.request(metodo, url, params=params, json=corpo)
+            latencias.append(time.perf_counter() - inicio)
+            if resposta.status_code >= 400:
+                erros += 1
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(trabalhador() for _ in range(args.concorrencia)))
+    duracao = time.perf_counter() - inicio
+
+    return {
+        "rps": len(latencias) / duracao,
+        "p50": percentil(latencias, 50) * 1000,
+        "p95": percentil(latencias, 95) * 1000,
+        "p99": percentil(latencias, 99) * 1000,
+        "erros": erros,
+    }
+
+
+async def executar(args) -> int:
+    import httpx
+    import main
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", params={"api_key": main.API_KEY}, timeout=None) as client:
+        dados = await popular(client, main, args)
+
+        atraso = args.latencia_ms / 1000
+        main.data_access.backend.latency = {"db": atraso, "auth": atraso, "blob": atraso}
+
+        print(f"{args.requisicoes} requisições por cenário, concorrência {args.concorrencia}, latência injetada {args.latencia_ms:g} ms")
+        print(f"{'cenário':<20} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'erros':>6}")
+        falhou = False
+        for cenario in args.cenarios:
+            for cache in (main.agenda_cache, main.user_cache, main.convite_cache):
+                cache.clear()
+            r = await rodar_cenario(client, cenario, dados, args)
+            falhou = falhou or r["erros"] > 0
+            print(f"{cenario:<20} {r['rps']:>9.1f} {r['p50']:>9.1f} {r['p95']:>9.1f} {r['p99']:>9.1f} {r['erros']:>6}")
+    return 1 if falhou else 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cenarios", nargs="+", choices=CENARIOS, default=list(CENARIOS))
+    parser.add_argument("--requisicoes", type=int, default=300)
+    parser.add_argument("--concorrencia", type=int, default=16)
+    parser.add_argument("--latencia-ms", type=float, default=10)
+    parser.add_argument("--agendas", type=int, default=200)
+    parser.add_argument("--usuarios", type=int, default=500)
+    parser.add_argument("--membros", type=int, default=30, help="membros por agenda")
+    parser.add_argument("--tarefas-por-lote", type=int, default=20)
+    parser.add_argument("--sem-cache", action="store_true", help="desliga os caches em memória da API")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    os.environ["COSMOS_BACKEND"] = "memory"
+    os.environ["MEMORY_BACKEND_LATENCY_MS"] = "0"
+    os.environ.setdefault("SECRET_API_WORD", "bench")
+    if args.sem_cache:
+        for nome in ("AGENDA_CACHE_MAX_ENTRIES", "USER_CACHE_MAX_ENTRIES", "INVITE_CACHE_MAX_ENTRIES"):
+            os.environ[nome] = "0"
+    sys.path.insert(0, API_DIR)
+
+    return asyncio.run(executar(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+"""Serialização e compressão de uma árvore de agendas grande.
+
+Monta uma árvore sintética parecida com a do /getAllAgendas e compara o
+caminho antigo (jsonable_encoder + json.dumps, o que o FastAPI faz com um
+dict e a JSONResponse padrão) com a RespostaJSON (orjson). Depois mede o
+tamanho e o tempo de compressão com gzip e brotli, com os mesmos
+compressores do CompressaoMiddleware.
+
+Uso:
+    python benchmarks/bench_serialization.py
+    python benchmarks/bench_serialization.py --agendas 2000 --itens 50 --runs 3
+"""
+
+import argparse
+import os
+import random
+import statistics
+import string
+import sys
+import time
+import uuid
+
+API_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api")
+
+
+def texto(tamanho: int) -> str:
+    return "".join(random.choices(string.ascii_letters + " áéíóúçã", k=tamanho))
+
+
+def arvore(agendas: int, itens: int) -> dict:
+    def item(campo):
+        return {campo: texto(30), "timestamp": f"2026-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}T10:00:00Z"}
+
+    return {
+        str(uuid.uuid4()): {
+            "nome_agenda": texto(20),
+            "chave_de_convite": texto(12),
+            "firstCreated": "2026-01-01T00:00:00Z",
+            "tarefas": {str(uuid.uuid4()): item("nome_da_tarefa") for _ in range(itens)},
+            "eventos": {str(uuid.uuid4()): item("nome_do_evento") for _ in range(itens // 2)},
+            "matérias": {
+                str(uuid.uuid4()): {"nome_matéria": texto(15), "professor": texto(15), "horario_de_início": "07:30", "horário_de_fim": "08:20"}
+                for _ in range(8)
+            },
+        }
+        for _ in range(agendas)
+    }
+
+
+def medir(funcao, runs: int):
+    tempos = []
+    for _ in range(runs):
+        inicio = time.perf_counter()
+        resultado = funcao()
+        tempos.append(time.perf_counter() - inicio)
+    return statistics.median(tempos) * 1000, resultado
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--agendas", type=int, default=500)
+    parser.add_argument("--itens", type=int, default=40, help="tarefas por agenda (eventos: metade)")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    os.environ["COSMOS_BACKEND"] = "memory"
+    os.environ.setdefault("SECRET_API_WORD", "bench")
+    sys.path.insert(0, API_DIR)
+
+    from fastapi.encoders import jsonable_encoder
+    from starlette.responses import JSONResponse
+    import main as api
+
+    dados = arvore(args.agendas, args.itens)
+
+    ms_antigo, corpo_antigo = medir(lambda: JSONResponse(jsonable_encoder(dados)).body, args.runs)
+    ms_orjson, corpo = medir(lambda: api.RespostaJSON(dados).body, args.runs)
+
+    print(f"árvore: {args.agendas} agendas, {args.itens} tarefas e {args.itens // 2} eventos por agenda")
+    print(f"{'serialização':<32} {'ms':>9} {'bytes':>12}")
+    print(f"{'jsonable_encoder + json.dumps':<32} {ms_antigo:>9.1f} {len(corpo_antigo):>12,}")
+    print(f"{'RespostaJSON (orjson)':<32} {ms_orjson:>9.1f} {len(corpo):>12,}")
+
+    codificacoes = ["gzip"] + (["br"] if api.brotli_disponivel() else [])
+    print()
+    print(f"{'na rede':<32} {'ms':>9} {'bytes':>12} {'razão':>7}")
+    print(f"{'sem compressão':<32} {0:>9.1f} {len(corpo):>12,} {1:>7.2f}")
+    for codificacao in codificacoes:
+        def comprimir():
+            compressor = api.novo_compressor(codificacao)
+            return compressor.compress(corpo) + compressor.flush()
+
+        ms, comprimido = medir(comprimir, args.runs)
+        print(f"{codificacao:<32} {ms:>9.1f} {len(comprimido):>12,} {len(corpo) / len(comprimido):>7.2f}")
+    if "br" not in codificacoes:
+        print("(brotli não instalado: só gzip)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
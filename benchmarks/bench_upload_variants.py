@@ -0,0 +1,128 @@
+"""Latência do /blob/uploadFile com e sem as variantes de imagem.
+
+Sobe a API num uvicorn local com o InMemoryBackend (latência injetada nas
+chamadas ao Blob e ao banco) e envia fotos sintéticas, todas diferentes para
+não cair na deduplicação, em cada um dos modos de variantes:
+
+    nenhuma   só o original
+    sincrona  a resposta espera as variantes
+    adiada    as variantes são geradas depois da resposta
+
+Para cada modo imprime a latência do upload (p50/p95) e, no modo adiado,
+quanto tempo depois do início do upload as variantes ficaram prontas.
+
+Uso:
+    python benchmarks/bench_upload_variants.py
+    python benchmarks/bench_upload_variants.py --uploads 20 --largura 4000 --altura 3000 --latencia-ms 30
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import random
+import statistics
+import sys
+import time
+
+API_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api")
+
+MODOS = ("nenhuma", "sincrona", "adiada")
+
+
+def foto(largura: int, altura: int, semente: int) -> bytes:
+    # Gradiente com ruído, para o JPEG ter um tamanho parecido com o de uma foto.
+    from PIL import Image
+
+    gerador = random.Random(semente)
+    imagem = Image.linear_gradient("L").resize((largura, altura)).convert("RGB")
+    ruido = Image.effect_noise((largura, altura), 40 + gerador.random() * 20).convert("RGB")
+    imagem = Image.blend(imagem, ruido, 0.35)
+    buffer = io.BytesIO()
+    imagem.save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def percentil(valores: list, p: float) -> float:
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, max(0, round(p / 100 * len(ordenados)) - 1))]
+
+
+async def esperar_variantes(backend, sha256: str, limite: float = 60) -> float:
+    inicio = time.perf_counter()
+    while time.perf_counter() - inicio < limite:
+        if backend.get(f"blobs_por_hash/{sha256}/variantes"):
+            return time.perf_counter()
+        await asyncio.sleep(0.005)
+    raise TimeoutError(f"variantes de {sha256} não ficaram prontas")
+
+
+async def executar(args) -> int:
+    import httpx
+    import uvicorn
+    import main
+
+    fotos = {modo: [foto(args.largura, args.altura, hash((modo, i))) for i in range(args.uploads)] for modo in args.modos}
+    tamanho_medio = statistics.mean(len(f) for lista in fotos.values() for f in lista)
+
+    servidor = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=args.porta, log_level="warning"))
+    tarefa = asyncio.create_task(servidor.serve())
+    while not servidor.started:
+        await asyncio.sleep(0.01)
+
+    atraso = args.latencia_ms / 1000
+    backend = main.data_access.backend
+    backend.latency = {"db": atraso, "auth": atraso, "blob": atraso}
+
+    print(f"{args.uploads} uploads por modo, fotos {args.largura}x{args.altura} (~{tamanho_medio / 1024**2:.1f} MB), latência injetada {args.latencia_ms:g} ms")
+    print(f"{'modo':<10} {'p50 ms':>9} {'p95 ms':>9} {'variantes prontas p50 ms':>26}")
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.porta}", params={"api_key": main.API_KEY}, timeout=None) as client:
+        # Aquece o pool de imagens para não medir a criação dos processos.
+        await asyncio.get_running_loop().run_in_executor(main.pool_de_imagens(), main.gerar_variantes_de_imagem, fotos[args.modos[0]][0])
+
+        for modo in args.modos:
+            latencias = []
+            prontas = []
+            for i, dados in enumerate(fotos[modo]):
+                inicio = time.perf_counter()
+                resposta = await client.post(
+                    "/blob/uploadFile",
+                    params={"variantes": modo},
+                    files={"file": (f"{modo}_{i}.jpg", dados, "image/jpeg")},
+                )
+                latencias.append(time.perf_counter() - inicio)
+                resposta.raise_for_status()
+                if modo == "adiada":
+                    prontas.append(await esperar_variantes(backend, resposta.json()["sha256"]) - inicio)
+                elif modo == "sincrona":
+                    prontas.append(latencias[-1])
+
+            pronto = f"{percentil(prontas, 50) * 1000:>26.1f}" if prontas else f"{'-':>26}"
+            print(f"{modo:<10} {percentil(latencias, 50) * 1000:>9.1f} {percentil(latencias, 95) * 1000:>9.1f} {pronto}")
+
+    servidor.should_exit = True
+    await tarefa
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modos", nargs="+", choices=MODOS, default=list(MODOS))
+    parser.add_argument("--uploads", type=int, default=10)
+    parser.add_argument("--largura", type=int, default=3000)
+    parser.add_argument("--altura", type=int, default=2000)
+    parser.add_argument("--latencia-ms", type=float, default=20)
+    parser.add_argument("--porta", type=int, default=8731)
+    args = parser.parse_args()
+
+    os.environ["COSMOS_BACKEND"] = "memory"
+    os.environ["MEMORY_BACKEND_LATENCY_MS"] = "0"
+    os.environ.setdefault("SECRET_API_WORD", "bench")
+    os.environ.setdefault("SLOW_REQUEST_MS", "60000")
+    sys.path.insert(0, API_DIR)
+
+    return asyncio.run(executar(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+"""Orçamento de cold start do api/main.py.
+
+O vercel.json manda todas as requisições para api/main.py, então todo cold
+start paga o import desse módulo. Este script importa o módulo em
+interpretadores novos, mede o tempo de import e a memória residente máxima
+e sai com código 1 se algum dos dois passar do orçamento, ou se algum módulo
+pesado (que deveria ser carregado só no primeiro uso) for importado junto.
+
+Uso:
+    python benchmarks/cold_start.py
+    python benchmarks/cold_start.py --max-import-ms 800 --max-rss-mb 60 --runs 7
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+API_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api")
+
+# Módulos que o import do main.py não pode carregar.
+LAZY_MODULES = ("firebase_admin", "vercel_blob", "phonenumbers")
+
+CHILD = """
+import json, resource, sys, time
+inicio = time.perf_counter()
+import main
+import_ms = (time.perf_counter() - inicio) * 1000
+print(json.dumps({
+    "import_ms": import_ms,
+    "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "carregados": [nome for nome in %r if nome in sys.modules],
+}))
+""" % (LAZY_MODULES,)
+
+
+def medir() -> dict:
+    env = dict(os.environ)
+    env.setdefault("SECRET_API_WORD", "cold-start")
+    resultado = subprocess.run(
+        [sys.executable, "-c", CHILD],
+        cwd=API_DIR, env=env, capture_output=True, text=True, check=True,
+    )
+    return json.loads(resultado.stdout.strip().splitlines()[-1])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-import-ms", type=float, default=float(os.getenv("COLD_START_MAX_IMPORT_MS", "1000")))
+    parser.add_argument("--max-rss-mb", type=float, default=float(os.getenv("COLD_START_MAX_RSS_MB", "80")))
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    medicoes = [medir() for _ in range(args.runs)]
+    import_ms = statistics.median(m["import_ms"] for m in medicoes)
+    rss_mb = max(m["rss_mb"] for m in medicoes)
+    carregados = sorted({nome for m in medicoes for nome in m["carregados"]})
+
+    print(f"import: {import_ms:.0f} ms (mediana de {args.runs}, orçamento {args.max_import_ms:.0f} ms)")
+    print(f"memória: {rss_mb:.1f} MB (máximo, orçamento {args.max_rss_mb:.0f} MB)")
+
+    falhas = []
+    if import_ms > args.max_import_ms:
+        falhas.append("tempo de import acima do orçamento")
+    if rss_mb > args.max_rss_mb:
+        falhas.append("memória acima do orçamento")
+    if carregados:
+        falhas.append(f"módulos carregados no import: {', '.join(carregados)}")
+
+    for falha in falhas:
+        print(f"FALHOU: {falha}")
+    return 1 if falhas else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())